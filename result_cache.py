@@ -0,0 +1,215 @@
+"""
+result_cache.py
+
+Persistent on-disk cache of skip graph optimizer results, keyed by a
+fingerprint of the demand and the call, so reruns of the experiments in
+static_opt_heuristics skip the demands they have already solved.
+"""
+import functools
+import hashlib
+import inspect
+import json
+import math
+import os
+import tempfile
+import numpy as np
+import static_optimal_search as st
+
+
+def demand_size(D):
+    """
+    number of keys of demand dict D (or st.SparseDemand)
+    """
+    if isinstance(D, st.SparseDemand):
+        return D.n
+    return int(math.sqrt(len(D)))
+
+
+def demand_fingerprint(D):
+    """
+    sha256 hex digest of the nonzero pairs (u, v, D(u,v)) of demand dict D
+    in key order, so a dict and the st.SparseDemand of the same demand, or
+    dicts filled in a different order, get the same fingerprint
+    """
+    if isinstance(D, st.SparseDemand):
+        u, v, w = D.u, D.v, D.w
+    else:
+        keys = sorted(k for k in D if D[k] != 0)
+        u = np.array([k[0] for k in keys], dtype = np.int64)
+        v = np.array([k[1] for k in keys], dtype = np.int64)
+        w = np.array([D[k] for k in keys], dtype = float)
+    h = hashlib.sha256()
+    h.update(str(demand_size(D)).encode())
+    for a, t in ((u, "<i8"), (v, "<i8"), (w, "<f8")):
+        h.update(np.ascontiguousarray(a, dtype = t).tobytes())
+    return h.hexdigest()
+
+
+def code_digest(code):
+    """
+    sha256 hex digest of a code object: its bytecode, the globals it names
+    and its constants, nested code objects included
+    """
+    h = hashlib.sha256(code.co_code)
+    h.update(repr(code.co_names).encode())
+    for c in code.co_consts:
+        h.update((code_digest(c) if inspect.iscode(c) else repr(c)).encode())
+    return h.hexdigest()
+
+
+def stable_repr(x, seen = ()):
+    """
+    repr of a parameter that does not change between runs: functions and
+    classes by their qualified name instead of their address. Functions
+    also carry a digest of their code, defaults and closure, since every
+    lambda has the qualified name <lambda> and closures share theirs.
+    """
+    if callable(x) and hasattr(x, "__qualname__"):
+        name = getattr(x, "__module__", "") + "." + x.__qualname__
+        code = getattr(x, "__code__", None)
+        if code is None or id(x) in seen:
+            return name
+        seen = seen + (id(x),)
+        cells = []
+        for c in x.__closure__ or ():
+            try:
+                cells.append(stable_repr(c.cell_contents, seen))
+            except ValueError:
+                # a cell whose variable is not assigned yet
+                cells.append("<empty>")
+        parts = [code_digest(code), stable_repr(x.__defaults__, seen), stable_repr(x.__kwdefaults__, seen)] + cells
+        return name + "#" + hashlib.sha256("|".join(parts).encode()).hexdigest()
+    if isinstance(x, dict):
+        return "{" + ", ".join(stable_repr(k, seen) + ": " + stable_repr(x[k], seen)
+                               for k in sorted(x, key = repr)) + "}"
+    if isinstance(x, (list, tuple)):
+        return type(x).__name__ + "(" + ", ".join(stable_repr(y, seen) for y in x) + ")"
+    return repr(x)
+
+
+def cache_key(D, algorithm, weight_fn = None, params = None):
+    """
+    sha256 hex digest of (demand fingerprint, n, algorithm, weight_fn,
+    params), where params is a dict of the other arguments of the call
+    """
+    key = {"demand" : demand_fingerprint(D), "n" : demand_size(D), "algorithm" : stable_repr(algorithm),
+           "weight_fn" : stable_repr(weight_fn), "params" : stable_repr(params or {})}
+    return hashlib.sha256(json.dumps(key, sort_keys = True).encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    Directory of (cost, tupled SG) results, one JSON file per key, holding
+    at most max_bytes of entries. Reading an entry marks it as used, and
+    the least recently used entries are evicted once the bound is passed.
+    Entries are written to a temporary file and renamed into place, so a
+    run killed mid-write, or two runs sharing the directory, never leave a
+    broken entry behind.
+    """
+    def __init__(self, path = "result_cache", max_bytes = 256*2**20):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok = True)
+
+    def file(self, key):
+        return os.path.join(self.path, key + ".json")
+
+    def get(self, key):
+        """
+        returns (cost, SG) stored under key, or None
+        """
+        try:
+            with open(self.file(key)) as f:
+                entry = json.load(f)
+            os.utime(self.file(key))
+        except (OSError, ValueError):
+            return None
+        return (entry["cost"], tuple(tuple(L) for L in entry["SG"]))
+
+    def put(self, key, cost, SG):
+        """
+        stores (cost, SG) under key, then evicts down to max_bytes
+        """
+        fd, tmp = tempfile.mkstemp(dir = self.path, suffix = ".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump({"cost" : cost, "SG" : [list(L) for L in SG]}, f)
+        os.replace(tmp, self.file(key))
+        self.evict()
+
+    def entries(self):
+        """
+        (last use, size, path) of every entry, least recently used first
+        """
+        out = []
+        for name in os.listdir(self.path):
+            if name.endswith(".json"):
+                p = os.path.join(self.path, name)
+                try:
+                    s = os.stat(p)
+                except OSError:
+                    continue
+                out.append((s.st_mtime, s.st_size, p))
+        return sorted(out)
+
+    def size(self):
+        return sum(e[1] for e in self.entries())
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(e[1] for e in entries)
+        for t, size, p in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        for t, size, p in self.entries():
+            os.remove(p)
+
+
+def cached(cache, ignore = ("processes",)):
+    """
+    decorator caching an optimizer f(D, ...) that returns a tupled SG (or
+    (cost, SG) with ret_cost = True) in ResultCache cache. The key is
+    cache_key of D, f, the weight_fn argument and every other argument
+    except ret_cost and the ones named in ignore, which must not change
+    the result. Only cache deterministic calls (seed randomized ones).
+    If f takes ret_cost the cost comes from f, otherwise it is computed by
+    st.epl_SG_vectorized; either way the wrapped f takes ret_cost.
+    """
+    def decorator(f):
+        sig = inspect.signature(f)
+        has_cost = "ret_cost" in sig.parameters
+
+        @functools.wraps(f)
+        def wrapper(D, *args, **kwargs):
+            # the wrapper takes ret_cost even where f does not
+            ret_cost = False if has_cost else kwargs.pop("ret_cost", False)
+            bound = sig.bind(D, *args, **kwargs)
+            bound.apply_defaults()
+            params = dict(list(bound.arguments.items())[1:])
+            ret_cost = params.pop("ret_cost", ret_cost)
+            weight_fn = params.pop("weight_fn", None)
+            for k in ignore:
+                params.pop(k, None)
+            key = cache_key(D, f, weight_fn, params)
+            result = cache.get(key)
+            if result is None:
+                if has_cost:
+                    bound.arguments["ret_cost"] = True
+                    result = f(*bound.args, **bound.kwargs)
+                else:
+                    SG = f(*bound.args, **bound.kwargs)
+                    result = (float(st.epl_SG_vectorized(SG, D)), SG)
+                result = (float(result[0]), tuple(tuple(L) for L in result[1]))
+                cache.put(key, *result)
+            if ret_cost:
+                return result
+            return result[1]
+        wrapper.cache = cache
+        return wrapper
+    return decorator
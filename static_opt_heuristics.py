@@ -1,8 +1,15 @@
 import static_optimal_search as st
+import result_cache
 import networkx as nx
 import random
 import csv
+import heapq
+import multiprocessing
+from multiprocessing import shared_memory
 import math, operator
+import copy
+import os
+import time
 import matplotlib.pyplot as plt
 from matplotlib.ticker import PercentFormatter
 import pandas as pd
@@ -35,15 +42,15 @@ def endpoint_sum(U, V, D, N):
     U_nodes = st.SG_nodes(U)
     V_nodes = st.SG_nodes(V)
     Ubar_nodes = set(N) - set(U_nodes)
+    U = st.IndexedSG(U)
+    UV = st.IndexedSG(U.SG + tuple(V) + (tuple(sorted(U_nodes + V_nodes)),))
     u_sum = 0
-    for u in U_nodes:
-        for up in Ubar_nodes:
-            d_U, result = st.SG_search_cost(U, u, up, return_value = True)
-            term = d_U + abs(result - up)
-            UV = U + V + (tuple(sorted(U_nodes + V_nodes)),)
-            d_UV, result = st.SG_search_cost(UV, u, up, return_value = True)
-            term -= d_UV + abs(result - up)
-            u_sum += term*D[(u,up)]
+    for u, up, w in st.demand_pairs(D, U_nodes, Ubar_nodes):
+        d_U, result = st.SG_search_cost(U, u, up, return_value = True)
+        term = d_U + abs(result - up)
+        d_UV, result = st.SG_search_cost(UV, u, up, return_value = True)
+        term -= d_UV + abs(result - up)
+        u_sum += term*w
     return u_sum
 
 
@@ -59,18 +66,106 @@ def local_distance_weight(U,V,D,N):
 def local_endpoint_sum(U,V,D):
     U_nodes = st.SG_nodes(U)
     V_nodes = st.SG_nodes(V)
+    U = st.IndexedSG(U)
+    UV = st.IndexedSG(U.SG + tuple(V) + (tuple(sorted(U_nodes + V_nodes)),))
     u_sum = 0
-    for u in U_nodes:
-        for up in V_nodes:
-            d_U, result = st.SG_search_cost(U, u, up, return_value = True)
-            term = d_U + abs(result - up)
-            UV = U + V + (tuple(sorted(U_nodes + V_nodes)),)
-            d_UV, result = st.SG_search_cost(UV, u, up, return_value = True)
-            term -= d_UV + abs(result - up)
-            u_sum += term*D[(u,up)]
+    for u, up, w in st.demand_pairs(D, U_nodes, set(V_nodes)):
+        d_U, result = st.SG_search_cost(U, u, up, return_value = True)
+        term = d_U + abs(result - up)
+        d_UV, result = st.SG_search_cost(UV, u, up, return_value = True)
+        term -= d_UV + abs(result - up)
+        u_sum += term*w
     return u_sum
 
 
+def demand_array(D, n):
+    """
+    returns the demand dict (or st.SparseDemand) D on keys 0..n-1 as a numpy matrix
+    """
+    M = np.zeros((n, n))
+    if isinstance(D, st.SparseDemand):
+        M[np.asarray(D.u, dtype = np.int64), np.asarray(D.v, dtype = np.int64)] = D.w
+    else:
+        for (u, v), w in D.items():
+            M[u, v] = w
+    return M
+
+
+def singleton_profile_arrays(M):
+    """
+    returns the profile arrays of every singleton {x} of the demand matrix M,
+    stacked so that row x belongs to {x}
+    """
+    n = len(M)
+    x = np.arange(n)[:, None]
+    ks = np.arange(n + 1)[None, :]
+    cnt = (ks > x).astype(np.int64)
+    wR = np.triu(M, 1)
+    mR = np.where(ks[:, :n] >= x, x, -1)
+    wL = np.tril(M, -1)
+    mL = np.where(ks[:, :n] <= x, x, n)
+    return (cnt, wR, mR, wL, mL)
+
+
+def profile_members(P):
+    """
+    0/1 membership rows of the stacked profile arrays P
+    """
+    return np.diff(P[0], axis = 1)
+
+
+def batch_endpoint_sum(P, Q, targets = None):
+    """
+    endpoint_sum(U, V) for many pairs of clusters at once, from profile arrays
+    stacked along the first axis (a single cluster is a stack of one and
+    broadcasts against the other side).
+    A search from u in U towards up outside U lands on r, the nearest key of U
+    towards up, whatever the shape of U. After the merge it goes on in the
+    merged list to t, the nearest key of U and V towards up, saving
+    |r - up| - |t - up| but paying the hops from r to t. So only the demand
+    from U into each up and the landing keys are needed.
+    targets are optional 0/1 rows of the keys up to sum over (all keys by default)
+    returns one sum per stacked pair
+    """
+    wR, mR, wL, mL = P[1:]
+    cntV, mRV, mLV = Q[0], Q[2], Q[4]
+    k = max(len(wR), len(cntV))
+    n = wR.shape[1]
+    cntV = np.broadcast_to(cntV, (k, n + 1))
+    right = (np.maximum(mR, mRV) - mR) - (cntV[:, 1:] - np.take_along_axis(cntV, np.broadcast_to(mR + 1, (k, n)), 1))
+    left = (mL - np.minimum(mL, mLV)) - (np.take_along_axis(cntV, np.broadcast_to(mL, (k, n)), 1) - cntV[:, :-1])
+    terms = wR*right + wL*left
+    if targets is not None:
+        terms = terms*targets
+    return terms.sum(axis = 1)
+
+
+def comprehensive_weight_batch(P, Q, W):
+    """
+    comprehensive_weight of every stacked pair of profile arrays P, Q
+    """
+    return batch_endpoint_sum(P, Q) + batch_endpoint_sum(Q, P)
+
+
+def local_distance_weight_batch(P, Q, W):
+    """
+    local_distance_weight of every stacked pair of profile arrays P, Q
+    """
+    return batch_endpoint_sum(P, Q, profile_members(Q)) + batch_endpoint_sum(Q, P, profile_members(P))
+
+
+def constant_distance_weight_batch(P, Q, W):
+    """
+    constant_distance_weight of every stacked pair of profile arrays P, Q,
+    where W[u][v] = |u - v|(D(u,v) + D(v,u))
+    """
+    return ((profile_members(P) @ W)*profile_members(Q)).sum(axis = 1)
+
+
+def constant_weight_batch(P, Q, W):
+    return np.ones(max(len(P[0]), len(Q[0])))
+
+
 def constant_distance_weight(U,V,D,N):
     """
     given skip graph U and skip graph V, only computes
@@ -79,9 +174,10 @@ def constant_distance_weight(U,V,D,N):
     s=0
     U_nodes = st.SG_nodes(U)
     V_nodes = st.SG_nodes(V)
-    for u in U_nodes:
-        for v in V_nodes:
-            s += abs(u - v)*(D[(u,v)] + D[(v,u)])
+    for u, v, w in st.demand_pairs(D, U_nodes, set(V_nodes)):
+        s += abs(u - v)*w
+    for v, u, w in st.demand_pairs(D, V_nodes, set(U_nodes)):
+        s += abs(u - v)*w
     return s
 
 
@@ -93,24 +189,218 @@ def constant_weight(U,V,D,N):
     return 1
 
 
+def candidate_pairs(D, n, k):
+    """
+    returns the sorted pairs (u, v), u > v, where v is one of the k keys with
+    the most demand D(u,v) + D(v,u) to or from u or the other way round, or
+    v = u - 1 so that the candidate graph stays connected.
+    D is a st.SparseDemand
+    """
+    u, v, w = D.u, D.v, D.w
+    off = u != v
+    a = np.concatenate((u[off], v[off]))
+    b = np.concatenate((v[off], u[off]))
+    w = np.concatenate((w[off], w[off]))
+    # total demand of every ordered pair (a, b)
+    pair, inv = np.unique(a*n + b, return_inverse = True)
+    w = np.bincount(inv, w, len(pair))
+    a, b = pair//n, pair % n
+    # rank partners by demand, ties by key
+    order = np.lexsort((b, -w, a))
+    a, b = a[order], b[order]
+    rank = np.arange(len(a)) - np.searchsorted(a, a)
+    a, b = a[rank < k], b[rank < k]
+    chain = np.arange(1, n)
+    hi = np.concatenate((np.maximum(a, b), chain))
+    lo = np.concatenate((np.minimum(a, b), chain - 1))
+    pair = np.unique(hi*n + lo)
+    return list(zip((pair//n).tolist(), (pair % n).tolist()))
+
+
+def sparse_singleton_profile(D, x):
+    """
+    returns the sparse profile (keys, ups, wR, wL, wD) of the singleton {x}
+    of st.SparseDemand D: the keys, the keys up outside them with demand from
+    them, that demand from the left and from the right of up, and the
+    demand weighted by distance, sum |u - up| D(u,up)
+    """
+    row = [(v, w) for v, w in D.rows[x] if v != x]
+    ups = np.array([v for v, w in row], dtype = np.int64)
+    w = np.array([w for v, w in row], dtype = float)
+    return (np.array([x], dtype = np.int64), ups, w*(ups > x), w*(ups < x), w*np.abs(ups - x))
+
+
+def merge_sparse_profiles(P, Q):
+    """
+    returns the sparse profile of the union of two disjoint clusters
+    """
+    keys = np.sort(np.concatenate((P[0], Q[0])))
+    ups, inv = np.unique(np.concatenate((P[1], Q[1])), return_inverse = True)
+    w = [np.bincount(inv, np.concatenate((P[c], Q[c])), len(ups)) for c in (2, 3, 4)]
+    i = np.minimum(np.searchsorted(keys, ups), len(keys) - 1)
+    out = keys[i] != ups
+    return (keys, ups[out]) + tuple(a[out] for a in w)
+
+
+def _shifted(arrays, span):
+    """
+    concatenates arrays, shifting the values of the j-th by j*span, and
+    returns it with the index j of every value and the bounds of every block
+    """
+    lens = np.fromiter(map(len, arrays), dtype = np.int64, count = len(arrays))
+    grp = np.repeat(np.arange(len(arrays)), lens)
+    ends = np.cumsum(lens)
+    return np.concatenate(arrays) + grp*span, grp, ends - lens, ends
+
+
+def _nearest(keys, lo, hi, x, below, above):
+    """
+    nearest keys of keys[lo:hi] at or left of x and at or right of x,
+    defaulting to below and above when there is none
+    """
+    i = np.searchsorted(keys, x, "right")
+    left = np.where(i > lo, keys[np.maximum(i - 1, 0)], below)
+    i = np.searchsorted(keys, x)
+    right = np.where(i < hi, keys[np.minimum(i, len(keys) - 1)], above)
+    return left, right
+
+
+def _member(keys, x):
+    return keys[np.minimum(np.searchsorted(keys, x), len(keys) - 1)] == x
+
+
+def _endpoint_terms(ups, wR, wL, rR, rL, keysV, lo, hi):
+    """
+    terms of batch_endpoint_sum for demand wR, wL into ups landing on rR, rL,
+    against the keys keysV[lo:hi]
+    """
+    tR, tL = _nearest(keysV, lo, hi, ups, rR, rL)
+    tR, tL = np.maximum(rR, tR), np.minimum(rL, tL)
+    right = (tR - rR) - (np.searchsorted(keysV, ups, "right") - np.searchsorted(keysV, rR, "right"))
+    left = (rL - tL) - (np.searchsorted(keysV, rL) - np.searchsorted(keysV, ups))
+    return wR*right + wL*left
+
+
+def sparse_endpoint_sums(P, Qs, local = False):
+    """
+    endpoint_sum(U, V) + endpoint_sum(V, U) for the sparse profile P of U
+    and every sparse profile in Qs, summing only over the keys each side has
+    demand to (only over those in the other side if local).
+    The profiles in Qs are concatenated with their keys shifted apart, so
+    that each direction takes a few vectorized searches for all of them.
+    """
+    keys, ups, wR, wL = P[:4]
+    d = len(Qs)
+    keysV, grpV, lo, hi = _shifted([Q[0] for Q in Qs], 0)
+    upsV, grpU, _, _ = _shifted([Q[1] for Q in Qs], 0)
+    # keys are below span, so shifted blocks never overlap
+    span = 1 + max(keys[-1], keysV.max(), ups.max(initial = 0), upsV.max(initial = 0))
+    keysV = keysV + grpV*span
+    # from U into every V: a search from U towards up only meets keys of V
+    # in the gap between consecutive keys of U that holds up, so only the
+    # ups in the gaps of U holding keys of V are visited
+    gap = np.searchsorted(keys, ups)
+    first = np.searchsorted(gap, np.arange(len(keys) + 2))
+    pairs = np.unique(grpV*(len(keys) + 1) + np.searchsorted(keys, keysV - grpV*span))
+    grp, gap = pairs//(len(keys) + 1), pairs % (len(keys) + 1)
+    lens = first[gap + 1] - first[gap]
+    grp = np.repeat(grp, lens)
+    idx = np.arange(lens.sum()) + np.repeat(first[gap] - (np.cumsum(lens) - lens), lens)
+    off = grp*span
+    rR, rL = _nearest(keys, 0, len(keys), ups[idx], ups[idx], ups[idx])
+    terms = _endpoint_terms(ups[idx] + off, wR[idx], wL[idx], rR + off, rL + off, keysV, lo[grp], hi[grp])
+    if local:
+        terms = terms*_member(keysV, ups[idx] + off)
+    s = np.bincount(grp, terms, d)
+    # from every V into U
+    grp = grpU
+    off = grp*span
+    upsV = upsV + off
+    rR, rL = _nearest(keysV, lo[grp], hi[grp], upsV, upsV, upsV)
+    upsV = upsV - off
+    terms = _endpoint_terms(upsV, np.concatenate([Q[2] for Q in Qs]), np.concatenate([Q[3] for Q in Qs]),
+                            rR - off, rL - off, keys, 0, len(keys))
+    if local:
+        terms = terms*_member(keys, upsV)
+    return s + np.bincount(grp, terms, d)
+
+
+def comprehensive_weight_sparse(P, Qs):
+    return sparse_endpoint_sums(P, Qs)
+
+
+def local_distance_weight_sparse(P, Qs):
+    return sparse_endpoint_sums(P, Qs, local = True)
+
+
+def constant_distance_weight_sparse(P, Qs):
+    keys, ups, wD = P[0], P[1], P[4]
+    d = len(Qs)
+    keysV, grp, _, _ = _shifted([Q[0] for Q in Qs], 0)
+    s = np.zeros(d)
+    if len(ups):
+        i = np.minimum(np.searchsorted(ups, keysV), len(ups) - 1)
+        s += np.bincount(grp, wD[i]*(ups[i] == keysV), d)
+    upsV, grp, _, _ = _shifted([Q[1] for Q in Qs], 0)
+    return s + np.bincount(grp, np.concatenate([Q[4] for Q in Qs])*_member(keys, upsV), d)
+
+
+def constant_weight_sparse(P, Qs):
+    return np.ones(len(Qs))
+
+
+# numpy kernels that ContractionGraph uses to weigh many edges per call
+BATCH_WEIGHTS = {comprehensive_weight : comprehensive_weight_batch,
+                 local_distance_weight : local_distance_weight_batch,
+                 constant_distance_weight : constant_distance_weight_batch,
+                 constant_weight : constant_weight_batch}
+
+# weights ContractionGraph looks up in its aggregated cluster x cluster
+# demand instead of computing them
+AGGREGATE_WEIGHTS = {constant_distance_weight}
+
+# and the ones SparseContractionGraph uses on sparse profiles
+SPARSE_WEIGHTS = {comprehensive_weight : comprehensive_weight_sparse,
+                  local_distance_weight : local_distance_weight_sparse,
+                  constant_distance_weight : constant_distance_weight_sparse,
+                  constant_weight : constant_weight_sparse}
+
+
 
 
 ##########################################################
 
-def init_graph(D, N, weight_fn = comprehensive_weight):
+def init_graph(D, N, weight_fn = comprehensive_weight, processes = 1, candidates = None):
     """
     Creates a graph object given by demand dict  D and list of nodes N.
     weight_fn takes two neghboring nodes U, V, and D, N and returns an edge weight for (U,V)
+    D can also be a st.SparseDemand
+    processes, candidates: see contraction_graph
+    """
+    G = contraction_graph(D, N, weight_fn, processes, candidates)
+    G.close()
+    return G.to_networkx()
+
+
+def contraction_graph(D, N, weight_fn = comprehensive_weight, processes = 1, candidates = None,
+                      aggregates = False):
+    """
+    returns the graph the contraction heuristics work on, which they pass
+    processes and candidates to:
+    - the ContractionGraph, whose edge weights are computed in a pool of
+      processes if processes != 1
+    - if candidates = k, the SparseContractionGraph, which only considers
+      merging each key with its k heaviest demand partners and its
+      neighbours in key order
+    aggregates = True keeps the cluster summaries (see init_aggregates)
+    even if weight_fn does not need them, for contractions weighed with
+    AGGREGATE_WEIGHTS or for weight_bounds.
     """
-    assert(len(D) == len(N)**2)
-    G = nx.Graph()
-    for k in D:
-        u,v = k[0],k[1]
-        if u > v: #undirected graph, so one edge per pair
-            U = ((u,),)
-            V = ((v,),)
-            G.add_edge(U,V , weight = weight_fn(U,V,D,N))
-    return G
+    if candidates is None:
+        return ContractionGraph(D, N, weight_fn, processes = processes, aggregates = aggregates)
+    if processes != 1:
+        raise ValueError("the sparsified candidate graph computes its weights serially")
+    return SparseContractionGraph(D, N, candidates, weight_fn, aggregates = aggregates)
 
 
 
@@ -133,39 +423,1557 @@ def collapse_edge(G, edge, D, N, weight_fn = comprehensive_weight):
     return Gp
 
 
-def greedy_edge_picking_heuristic(D, N, weight_fn = comprehensive_weight):
+class MatrixDemand:
+    """
+    Read-only demand dict view of a numpy demand matrix
+    """
+    def __init__(self, M):
+        self.M = M
+
+    def __getitem__(self, k):
+        return float(self.M[k])
+
+    def __len__(self):
+        return self.M.size
+
+    def __iter__(self):
+        n = len(self.M)
+        return ((u,v) for u in range(n) for v in range(n))
+
+    def __contains__(self, k):
+        return 0 <= k[0] < len(self.M) and 0 <= k[1] < len(self.M)
+
+    def items(self):
+        return (((u,v), self[(u,v)]) for u,v in self)
+
+
+def shared_weight_arrays(buf, n, m):
+    """
+    views of the shared block buf of the weight pool: the demand matrix M,
+    the matrix W of ContractionGraph and the profile arrays (cnt, wR, mR,
+    wL, mL) of clusters 0..m-1, where row i belongs to cluster i
+    """
+    shapes = [((n, n), float), ((n, n), float), ((m, n + 1), np.int64), ((m, n), float),
+              ((m, n), np.int64), ((m, n), float), ((m, n), np.int64)]
+    arrays, offset = [], 0
+    for shape, dtype in shapes:
+        arrays.append(np.ndarray(shape, dtype = dtype, buffer = buf, offset = offset))
+        offset += 8*shape[0]*shape[1]
+    return arrays
+
+
+_weight_worker = {}
+
+def _init_weight_worker(shm_name, n, m, N):
+    shm = shared_memory.SharedMemory(name = shm_name)
+    arrays = shared_weight_arrays(shm.buf, n, m)
+    _weight_worker.update(shm = shm, W = arrays[1], D = MatrixDemand(arrays[0]), N = N,
+                          profiles = tuple(arrays[2:]))
+
+def _weigh_edges(task):
+    """
+    returns [weight_fn(U, V, D, N) for V in Vs] for task (weight_fn, i, js,
+    payloads), where U, Vs are the payloads of cluster i and clusters js,
+    with the demand read from shared memory. The weight functions in
+    BATCH_WEIGHTS read the profiles of i and js from shared memory instead
+    and get no payloads.
+    """
+    weight_fn, i, js, payloads = task
+    if weight_fn in BATCH_WEIGHTS:
+        profiles = _weight_worker["profiles"]
+        P = tuple(a[[i]] for a in profiles)
+        Q = tuple(a[js] for a in profiles)
+        return BATCH_WEIGHTS[weight_fn](P, Q, _weight_worker["W"]).tolist()
+    U, Vs = payloads
+    return [weight_fn(U, V, _weight_worker["D"], _weight_worker["N"]) for V in Vs]
+
+
+class ContractionGraph:
+    """
+    Lightweight stand-in for the networkx graph contracted by the heuristics.
+    Every cluster has an integer ID and holds its tupled SG as payload, and
+    edge weights live in per-cluster adjacency dicts. contract merges two
+    clusters in place instead of copying the whole graph twice.
+    Each cluster also caches the st.subset_profile of its keys as numpy
+    arrays, merged in O(n) per contraction, so the weight functions in
+    BATCH_WEIGHTS weigh all the edges of a cluster in one vectorized call
+    instead of running O(|U| n) searches per edge. The demand between
+    clusters and a few per-cluster sums are aggregated too (see
+    init_aggregates) if weight_fn is in AGGREGATE_WEIGHTS or aggregates =
+    True, which makes those weights lookups and gives weight_bounds for the
+    others.
+
+    Edges are listed in the order networkx would list them for the graph built
+    by init_graph and contracted by collapse_edge: by rank of the earlier
+    endpoint (IDs are ranks), then by when the later endpoint became its
+    neighbour. This keeps tie breaking, and hence the heuristics' output,
+    unchanged.
+
+    processes > 1 (or None for all cores) computes the weights in a pool of
+    processes that read the demand matrix from shared memory, along with a
+    row per cluster ID holding its cached profile; share_profiles refreshes
+    the rows of the clusters a task reads, so a task carries IDs only. Call
+    close() when done to free the pool and the shared block.
+    """
+    def __init__(self, D, N, weight_fn = comprehensive_weight, processes = 1, aggregates = False):
+        if isinstance(D, st.SparseDemand):
+            pairs = [(u,v) for u in N for v in N]
+        else:
+            assert(len(D) == len(N)**2)
+            pairs = D
+        n = max(N) + 1
+        M = demand_array(D, n)
+        self.W = np.abs(np.subtract.outer(np.arange(n), np.arange(n)))*(M + M.T)
+        self.pool = self.shm = None
+        self.workers = processes or os.cpu_count()
+        singles = singleton_profile_arrays(M)
+        self.add_singletons(pairs, lambda x : tuple(a[x] for a in singles))
+        if processes != 1:
+            m = len(self.payload)
+            self.shm = shared_memory.SharedMemory(create = True, size = 8*(2*n*n + m*(n + 1) + 4*m*n))
+            arrays = shared_weight_arrays(self.shm.buf, n, m)
+            arrays[0][:], arrays[1][:] = M, self.W
+            self.shared_profiles = tuple(arrays[2:])
+            keys = [self.payload[i][0][0] for i in range(m)]
+            for a, rows in zip(self.shared_profiles, singles):
+                a[:] = rows[keys]
+            # shared[i] is the profile held in row i, the same for all copies
+            self.shared = dict(self.profiles)
+            self.pool = multiprocessing.Pool(processes, initializer = _init_weight_worker,
+                                             initargs = (self.shm.name, n, m, list(N)))
+        self.aggregated = aggregates or weight_fn in AGGREGATE_WEIGHTS
+        if self.aggregated:
+            u, v = np.nonzero(M)
+            self.init_aggregates(u, v, M[u, v])
+        # weigh the edges of each cluster in one call
+        by_first = self.init_edges_by_first()
+        if weight_fn in AGGREGATE_WEIGHTS:
+            results = [self.weights(i, js, D, N, weight_fn) for i, js in by_first.items()]
+        elif self.pool is not None:
+            results = self.pool_weights(list(by_first.items()), weight_fn)
+        else:
+            key = np.array([self.payload[i][0][0] for i in range(len(self.payload))], dtype = np.int64)
+            results = []
+            for i, js in by_first.items():
+                if weight_fn in BATCH_WEIGHTS:
+                    P = tuple(a[key[i:i+1]] for a in singles)
+                    Q = tuple(a[key[js]] for a in singles)
+                    results.append(BATCH_WEIGHTS[weight_fn](P, Q, self.W).tolist())
+                else:
+                    results.append(self.weights(i, js, D, N, weight_fn))
+        for (i, js), ws in zip(by_first.items(), results):
+            for j, w in zip(js, ws):
+                self.nbrs[i][j] = self.nbrs[j][i] = w
+        self.index_edges()
+
+    def add_singletons(self, pairs, profile):
+        """
+        adds an edge for every pair (u, v) with u > v, and a singleton cluster
+        with profile(x) for every key x the first time it shows up
+        """
+        self.payload = {}
+        self.profiles = {}
+        self.singleton = {}
+        self.nbrs = {}
+        self.init_edges = []
+        for k in pairs:
+            u,v = k[0],k[1]
+            if u > v: #undirected graph, so one edge per pair
+                for x in (u, v):
+                    if x not in self.singleton:
+                        self.singleton[x] = len(self.payload)
+                        self.payload[len(self.payload)] = ((x,),)
+                        self.profiles[self.singleton[x]] = profile(x)
+                        self.nbrs[self.singleton[x]] = {}
+                self.init_edges.append((self.singleton[u], self.singleton[v]))
+
+    def init_edges_by_first(self):
+        by_first = {}
+        for i, j in self.init_edges:
+            by_first.setdefault(i, []).append(j)
+        return by_first
+
+    def init_aggregates(self, u, v, w):
+        """
+        sets up the cluster summaries from the demand pairs (u, v, w) on
+        keys, in the style of Lance-Williams updates in hierarchical
+        clustering: merge_aggregates combines the rows of two clusters in
+        O(#clusters) instead of going back to the demand.
+        dist[i][j] and total[i][j] are the demand between clusters i and j,
+        both ways, with and without the factor |u - v| (so dist is
+        constant_distance_weight). out[i] and dout[i] are the demand from i
+        to keys outside it, likewise. lo[i] and hi[i] are the smallest and
+        largest key of i.
+        """
+        ids = np.full(max(self.singleton) + 1, -1, dtype = np.int64)
+        ids[list(self.singleton)] = list(self.singleton.values())
+        off = u != v
+        u, v, w = u[off], v[off], w[off]
+        i, j = ids[u], ids[v]
+        m = len(self.payload)
+        d = np.abs(u - v)*w
+        self.out = dict(enumerate(np.bincount(i, w, m).tolist()))
+        self.dout = dict(enumerate(np.bincount(i, d, m).tolist()))
+        pair, inv = np.unique(np.concatenate((i*m + j, j*m + i)), return_inverse = True)
+        a, b = pair//m, pair % m
+        cut = np.searchsorted(a, np.arange(m + 1))
+        for name, x in (("dist", d), ("total", w)):
+            x = np.bincount(inv, np.concatenate((x, x)), len(pair))
+            setattr(self, name, {k : dict(zip(b[cut[k]:cut[k+1]].tolist(), x[cut[k]:cut[k+1]].tolist()))
+                                 for k in range(m)})
+        self.lo = {k : P[0][0] for k, P in self.payload.items()}
+        self.hi = dict(self.lo)
+
+    def merge_aggregates(self, u, v):
+        """
+        folds the summaries of cluster v into those of cluster u
+        """
+        self.out[u] += self.out.pop(v) - self.total[u].get(v, 0.0)
+        self.dout[u] += self.dout.pop(v) - self.dist[u].get(v, 0.0)
+        self.lo[u] = min(self.lo[u], self.lo.pop(v))
+        self.hi[u] = max(self.hi[u], self.hi.pop(v))
+        for agg in (self.dist, self.total):
+            row = agg.pop(v)
+            row.pop(u, None)
+            agg[u].pop(v, None)
+            for x, c in row.items():
+                agg[u][x] = agg[x][u] = agg[u].get(x, 0.0) + c
+                del agg[x][v]
+
+    def weight_bounds(self, i, js, weight_fn = comprehensive_weight):
+        """
+        upper bounds on weights(i, js) in O(1) per edge from the cluster
+        summaries, or None if weight_fn has none. A search from u to up that
+        lands on r before the merge and on t after saves at most |r - t|,
+        which is at most |u - up| and at most the span of the merged
+        cluster, and it saves nothing unless up is in the other cluster for
+        local_distance_weight. Needs the aggregates.
+        """
+        if weight_fn in AGGREGATE_WEIGHTS or weight_fn is local_distance_weight:
+            return [self.dist[i].get(j, 0.0) for j in js]
+        if weight_fn is comprehensive_weight:
+            out = []
+            for j in js:
+                span = max(self.hi[i], self.hi[j]) - min(self.lo[i], self.lo[j])
+                out.append(min(span*self.out[i], self.dout[i]) + min(span*self.out[j], self.dout[j]))
+            return out
+        if weight_fn is constant_weight:
+            return [1]*len(js)
+        return None
+
+    def index_edges(self):
+        """
+        sets up the edge order once the weights are in
+        """
+        # later[i][j] orders the neighbours j of i with a larger ID
+        self.later = {i : {} for i in self.payload}
+        self.stamp = 0
+        for i in self.payload:
+            for j in self.nbrs[i]:
+                if j > i:
+                    self.add_later(i, j)
+        self.contracted = False
+
+    def __len__(self):
+        return len(self.payload)
+
+    def merge_profiles(self, P, Q):
+        cnt, wR, mR, wL, mL = P
+        cntV, wRV, mRV, wLV, mLV = Q
+        return (cnt + cntV, wR + wRV, np.maximum(mR, mRV), wL + wLV, np.minimum(mL, mLV))
+
+    def split_cost(self, i, j):
+        """
+        st.split_cost of the keys of clusters i and j, i.e. how much merging
+        them adds to the EPL
+        """
+        return split_cost_arrays(self.profiles[i], self.profiles[j])
+
+    def copy(self):
+        """
+        copy that can be contracted on its own, sharing the demand arrays
+        and the weight pool with this graph (close only the original)
+        """
+        G = copy.copy(self)
+        G.payload, G.profiles = dict(self.payload), dict(self.profiles)
+        G.nbrs = {i : dict(a) for i, a in self.nbrs.items()}
+        G.later = {i : dict(a) for i, a in self.later.items()}
+        if self.aggregated:
+            G.dist = {i : dict(a) for i, a in self.dist.items()}
+            G.total = {i : dict(a) for i, a in self.total.items()}
+            G.out, G.dout, G.lo, G.hi = dict(self.out), dict(self.dout), dict(self.lo), dict(self.hi)
+        return G
+
+    def close(self):
+        """
+        shuts down the weight pool and frees the shared demand matrix
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.shm.close()
+            self.shm.unlink()
+            self.pool = self.shm = None
+
+    def add_later(self, i, j):
+        self.later[i][j] = self.stamp
+        self.stamp += 1
+
+    def weight(self, i, j, D, N, weight_fn = comprehensive_weight):
+        """
+        returns weight_fn(payload of i, payload of j, D, N)
+        """
+        return self.weights(i, [j], D, N, weight_fn)[0]
+
+    def weights(self, i, js, D, N, weight_fn = comprehensive_weight):
+        """
+        returns the list of weight_fn(payload of i, payload of j, D, N) for j in js
+        """
+        if weight_fn in AGGREGATE_WEIGHTS and self.aggregated:
+            return [self.dist[i].get(j, 0.0) for j in js]
+        if self.pool is not None:
+            size = max(1, -(-len(js)//self.workers))
+            work = [(i, js[k:k+size]) for k in range(0, len(js), size)]
+            return [w for ws in self.pool_weights(work, weight_fn) for w in ws]
+        if weight_fn in BATCH_WEIGHTS:
+            P = tuple(a[None] for a in self.profiles[i])
+            Q = tuple(np.stack([self.profiles[j][c] for j in js]) for c in range(5))
+            return BATCH_WEIGHTS[weight_fn](P, Q, self.W).tolist()
+        return [weight_fn(self.payload[i], self.payload[j], D, N) for j in js]
+
+    def share_profiles(self, ids):
+        """
+        writes the cached profiles of clusters ids to their rows in shared
+        memory, skipping the rows that hold them already. Copies share the
+        rows, so a row is rewritten when another copy has used it since.
+        """
+        for i in ids:
+            P = self.profiles[i]
+            if self.shared.get(i) is not P:
+                for a, row in zip(self.shared_profiles, P):
+                    a[i] = row
+                self.shared[i] = P
+
+    def pool_weights(self, work, weight_fn):
+        """
+        returns the list of weights(i, js) for (i, js) in work, computed in
+        the pool
+        """
+        if weight_fn in BATCH_WEIGHTS:
+            self.share_profiles({x for i, js in work for x in [i] + list(js)})
+            tasks = [(weight_fn, i, list(js), None) for i, js in work]
+        else:
+            tasks = [(weight_fn, i, list(js), (self.payload[i], [self.payload[j] for j in js])) for i, js in work]
+        return self.pool.map(_weigh_edges, tasks)
+
+    def edge_order(self, i, j):
+        """
+        sort key of edge (i, j) in networkx edge order
+        """
+        if i > j:
+            i, j = j, i
+        return (i, self.later[i][j])
+
+    def edges(self):
+        """
+        yields (i, j, weight) in networkx edge order
+        """
+        for i in sorted(self.payload):
+            for j in sorted(self.later[i], key = self.later[i].get):
+                yield (i, j, self.nbrs[i][j])
+
+    def to_networkx(self):
+        """
+        returns the equivalent networkx graph, with payloads as nodes
+        """
+        G = nx.Graph()
+        if self.contracted:
+            edges = self.edges()
+        else:
+            # same insertion order as init_graph
+            edges = ((i, j, self.nbrs[i][j]) for i, j in self.init_edges)
+        for i, j, w in edges:
+            G.add_edge(self.payload[i], self.payload[j], weight = w)
+        return G
+
+    def contract(self, u, v, D, N, weight_fn = comprehensive_weight, reweigh = True):
+        """
+        merges cluster v into cluster u (as collapse_edge(G, (u, v)) does)
+        and recomputes the weights of the edges of u, or sets them to None
+        if reweigh = False, for callers that weigh them lazily
+        """
+        # v's neighbours in the order networkx contracts them in
+        if not self.contracted:
+            v_order = list(self.nbrs[v])
+            self.contracted = True
+        else:
+            v_order = sorted([x for x in self.nbrs[v] if x < v])
+            v_order += sorted(self.later[v], key = self.later[v].get)
+        for x in self.nbrs[v]:
+            del self.nbrs[x][v]
+            self.later[x].pop(v, None)
+        for x in v_order:
+            if x != u and x not in self.nbrs[u]:
+                self.nbrs[u][x] = self.nbrs[x][u] = None
+                if x > u:
+                    self.add_later(u, x)
+                else:
+                    self.add_later(x, u)
+        U, V = self.payload[u], self.payload.pop(v)
+        self.payload[u] = U + V + (tuple(sorted(st.SG_nodes(U) + st.SG_nodes(V))),)
+        self.profiles[u] = self.merge_profiles(self.profiles[u], self.profiles.pop(v))
+        if self.aggregated:
+            self.merge_aggregates(u, v)
+        del self.nbrs[v], self.later[v]
+        xs = list(self.nbrs[u])
+        if not reweigh:
+            for x in xs:
+                self.nbrs[u][x] = self.nbrs[x][u] = None
+        elif xs:
+            for x, w in zip(xs, self.weights(u, xs, D, N, weight_fn)):
+                self.nbrs[u][x] = self.nbrs[x][u] = w
+        return u
+
+
+class SparseContractionGraph(ContractionGraph):
+    """
+    ContractionGraph on a sparsified candidate graph, for large sparse
+    demands: only the candidate_pairs(D, n, k) get an edge, and each cluster
+    keeps a sparse profile (sparse_singleton_profile) over the keys it has
+    demand to instead of O(n) arrays. The graph holds O(n k) edges and a
+    contraction reweighs the edges of the merged cluster in time linear in
+    their profiles, so no O(n^2) structure is ever built.
+    D is a demand dict or a st.SparseDemand.
+    """
+    def __init__(self, D, N, k, weight_fn = comprehensive_weight, aggregates = False):
+        if not isinstance(D, st.SparseDemand):
+            D = st.sparse_demand(D)
+        self.pool = self.shm = None
+        self.add_singletons(candidate_pairs(D, max(N) + 1, k), lambda x : sparse_singleton_profile(D, x))
+        self.aggregated = aggregates or weight_fn in AGGREGATE_WEIGHTS
+        if self.aggregated:
+            self.init_aggregates(D.u, D.v, D.w)
+        for i, js in self.init_edges_by_first().items():
+            for j, w in zip(js, self.weights(i, js, D, N, weight_fn)):
+                self.nbrs[i][j] = self.nbrs[j][i] = w
+        self.index_edges()
+
+    def merge_profiles(self, P, Q):
+        return merge_sparse_profiles(P, Q)
+
+    def split_cost(self, i, j):
+        # pairs inside a cluster cost nothing to split, so the sparse
+        # profiles (keys, ups, wR, wL) over the keys outside are enough
+        return sparse_split_cost(self.profiles[i][:4], self.profiles[j][:4])
+
+    def weights(self, i, js, D, N, weight_fn = comprehensive_weight):
+        if weight_fn in AGGREGATE_WEIGHTS and self.aggregated:
+            return [self.dist[i].get(j, 0.0) for j in js]
+        if weight_fn in SPARSE_WEIGHTS:
+            return SPARSE_WEIGHTS[weight_fn](self.profiles[i], [self.profiles[j] for j in js]).tolist()
+        return [weight_fn(self.payload[i], self.payload[j], D, N) for j in js]
+
+
+def greedy_edge_picking_heuristic(D, N, weight_fn = comprehensive_weight, processes = 1, candidates = None,
+                                  lazy = False):
     """
     iteratively collapses the maximum weight edge in the graph, merging the two nodes,
     then recomputing edge weights.
     Final node at the end is the skip graph returned by the heuristic.
+    lazy = True weighs merged edges only once their weight_bounds reach the top.
     """
-    G = init_graph(D, N)
-    currG = G
-    # find max weight edge
-    while len(currG.nodes) > 1:
-        edges_by_inc_weight = sorted(currG.edges(data=True), key = lambda x : x[2]['weight'], reverse = True)
-        to_collapse = (edges_by_inc_weight[0][0], edges_by_inc_weight[0][1])
-        currG = collapse_edge(currG, to_collapse, D, N, weight_fn)
+    # lazy only pays where weighing an edge costs more than bounding it
+    lazy = lazy and processes == 1 and weight_fn in (comprehensive_weight, local_distance_weight)
+    G = contraction_graph(D, N, processes = processes, candidates = candidates,
+                          aggregates = lazy or weight_fn in AGGREGATE_WEIGHTS)
+    # a max-heap of edges whose entries carry the version stamps of their
+    # endpoints: merging bumps a stamp, so stale entries are dropped when
+    # popped, and ties go in networkx edge order. A lazy bound is weighed
+    # with the other pending edges of its node, and can only sink.
+    version = {i : 0 for i in G.payload}
+    heap = []
+    pending = {}
+
+    def push(i, j, w = None):
+        if i > j:
+            i, j = j, i
+        exact = w is None
+        if exact:
+            w = G.nbrs[i][j]
+        heapq.heappush(heap, (-w,) + G.edge_order(i, j) + (i, j, version[i], version[j], exact))
+
+    try:
+        for i, j, w in G.edges():
+            push(i, j)
+        while len(G) > 1:
+            w, r, s, u, v, ver_u, ver_v, exact = heapq.heappop(heap)
+            if u not in G.payload or v not in G.payload or version[u] != ver_u or version[v] != ver_v:
+                continue
+            if not exact:
+                if G.nbrs[u][v] is None:
+                    c = u if v in pending.get(u, ()) else v
+                    xs = [x for x in pending.pop(c) if x in G.nbrs[c] and G.nbrs[c][x] is None]
+                    for x, w in zip(xs, G.weights(c, xs, D, N, weight_fn)):
+                        G.nbrs[c][x] = G.nbrs[x][c] = w
+                        push(c, x)
+                continue
+            G.contract(u, v, D, N, weight_fn, reweigh = not lazy)
+            version[u] += 1
+            xs = list(G.nbrs[u])
+            if lazy:
+                pending[u] = xs
+                for x, b in zip(xs, G.weight_bounds(u, xs, weight_fn)):
+                    push(u, x, b*(1 + 1e-9) + 1e-12)
+            else:
+                for x in xs:
+                    push(u, x)
+    finally:
+        G.close()
     # return resulting skip graph
-    return list(currG.nodes)[0]
+    return list(G.payload.values())[0]
 
 
-def greedy_matching_heuristic(D,N, weight_fn = comprehensive_weight):
+def beam_search_heuristic(D, N, beam_width = 4, weight_fn = comprehensive_weight, processes = 1,
+                          candidates = None, ret_cost = False):
+    """
+    beam search over the contraction sequences of greedy_edge_picking_heuristic,
+    keeping the beam_width states with the lowest sum of split costs so far.
+    beam_width = 1 gives greedy's skip graph, and wider beams never do worse.
+    """
+    root = contraction_graph(D, N, processes = processes, candidates = candidates,
+                              aggregates = weight_fn in AGGREGATE_WEIGHTS)
+    # (score, lists built so far, graph, on greedy's path). Every state
+    # proposes its beam_width heaviest edges and the cheapest proposals make
+    # the next beam, a state reached by two orders counting once; ties go
+    # to the better parent, then to greedy's edge order
+    beam = [(0.0, frozenset(), root, True)]
+    try:
+        for step in range(len(root) - 1):
+            proposals = []
+            for r, (score, lists, G, greedy) in enumerate(beam):
+                top = heapq.nsmallest(beam_width, ((-w, i, G.later[i][j], j) for i in G.payload
+                                                   for j, w in G.nbrs[i].items() if j > i))
+                for k, (w, i, order, j) in enumerate(top):
+                    proposals.append((score + G.split_cost(i, j), r, w, order, i, j, greedy and k == 0))
+            proposals.sort(key = lambda x : x[:4])
+            nxt, seen = [], {}
+            for score, r, w, order, i, j, greedy in proposals:
+                G, lists = beam[r][2], beam[r][1]
+                lists = lists | {tuple(sorted(G.payload[i][-1] + G.payload[j][-1]))}
+                if lists in seen:
+                    # the same state, reached by another order
+                    if greedy:
+                        nxt[seen[lists]] = nxt[seen[lists]][:3] + (True,)
+                    continue
+                if len(nxt) == beam_width:
+                    # keep greedy's path in the beam, so the result is
+                    # never worse than greedy_edge_picking_heuristic's
+                    if not greedy or any(x[3] for x in nxt):
+                        continue
+                    seen.pop(nxt.pop()[1])
+                seen[lists] = len(nxt)
+                G = G.copy()
+                G.contract(i, j, D, N, weight_fn)
+                nxt.append((score, lists, G, greedy))
+            beam = nxt
+    finally:
+        root.close()
+    score, lists, G, greedy = min(beam, key = lambda x : x[0])
+    SG = list(G.payload.values())[0]
+    if ret_cost:
+        return (score, SG)
+    return SG
+
+
+def blossom_matching(G):
+    """
+    max-weight matching of ContractionGraph G, as pairs of cluster IDs,
+    from networkx's blossom algorithm (O(n^3))
+    """
+    H = G.to_networkx()
+    ids = {G.payload[i] : i for i in G.payload}
+    return [(ids[edge[0]], ids[edge[1]]) for edge in nx.max_weight_matching(H)]
+
+
+def greedy_matching(G):
+    """
+    1/2-approximate max-weight matching of ContractionGraph G: scans the edges
+    from heaviest to lightest (ties in edge order) and keeps every edge whose
+    endpoints are both still free. O(m log m)
+    """
+    matched = set()
+    matching = []
+    for i, j, w in sorted(G.edges(), key = lambda e : -e[2]):
+        if i not in matched and j not in matched:
+            matched.update((i, j))
+            matching.append((i, j))
+    return matching
+
+
+def path_growing_matching(G):
+    """
+    1/2-approximate max-weight matching of ContractionGraph G by path growing
+    (Drake and Hougardy): from each cluster left, grows a path along the
+    heaviest edge to a cluster not yet on a path, adding its edges to two
+    matchings in turn, and returns the heavier one. O(m)
+    """
+    matchings, weights = ([], []), [0, 0]
+    removed = set()
+    for x in sorted(G.payload):
+        k = 0
+        while x not in removed:
+            removed.add(x)
+            best = None
+            for y, w in G.nbrs[x].items():
+                if y not in removed and (best is None or w > best[1] or (w == best[1] and y < best[0])):
+                    best = (y, w)
+            if best is None:
+                break
+            matchings[k].append((x, best[0]))
+            weights[k] += best[1]
+            k = 1 - k
+            x = best[0]
+    return matchings[0] if weights[0] >= weights[1] else matchings[1]
+
+
+MATCHING_ENGINES = {"blossom" : blossom_matching,
+                    "greedy" : greedy_matching,
+                    "path_growing" : path_growing_matching}
+
+
+def greedy_matching_heuristic(D,N, weight_fn = comprehensive_weight, processes = 1, candidates = None, matching = "blossom"):
     """
     iteratively collapses the max-weight matching in the graph,
     then recomputing edge weights.
     Final node at the end is the skip graph returned by the heuristic.
+    matching names the engine in MATCHING_ENGINES.
     """
-    G = init_graph(D, N)
-    currG = G
-    # find max weight matching
-    while len(currG.nodes) > 1:
-        matching = nx.max_weight_matching(currG)
-        for edge in matching:
-            to_collapse = (edge[0], edge[1])
-            currG = collapse_edge(currG, to_collapse, D, N, weight_fn)
+    engine = MATCHING_ENGINES[matching]
+    G = contraction_graph(D, N, processes = processes, candidates = candidates,
+                           aggregates = weight_fn in AGGREGATE_WEIGHTS)
+    try:
+        # find max weight matching
+        while len(G) > 1:
+            for u, v in engine(G):
+                G.contract(u, v, D, N, weight_fn)
+    finally:
+        G.close()
     # return resulting skip graph
-    return list(currG.nodes)[0]
+    return list(G.payload.values())[0]
+
+
+def softmax_index(ws, temperature, rng = random):
+    """
+    samples an index of the weights ws, heaviest first, with probability
+    proportional to exp((ws[i] - ws[0])/(temperature*|ws[0]|)), so
+    temperature is relative to the heaviest weight (0 always picks it)
+    """
+    if temperature == 0 or len(ws) == 1:
+        return 0
+    scale = temperature*max(abs(ws[0]), 1e-12)
+    return rng.choices(range(len(ws)), weights = [math.exp((w - ws[0])/scale) for w in ws])[0]
+
+
+def randomized_greedy_matching(G, top_k, temperature, rng = random):
+    """
+    greedy_matching of ContractionGraph G, except that each edge is sampled
+    by softmax_index among the top_k heaviest edges between free endpoints
+    """
+    edges = sorted(G.edges(), key = lambda e : -e[2])
+    matched = set()
+    matching = []
+    top, pos = [], 0
+    while True:
+        top = [e for e in top if e[0] not in matched and e[1] not in matched]
+        while len(top) < top_k and pos < len(edges):
+            if edges[pos][0] not in matched and edges[pos][1] not in matched:
+                top.append(edges[pos])
+            pos += 1
+        if not top:
+            return matching
+        i, j, w = top.pop(softmax_index([e[2] for e in top], temperature, rng))
+        matched.update((i, j))
+        matching.append((i, j))
+
+
+def randomized_greedy_heuristic(D, N, top_k = 4, temperature = 0.1, matching = False,
+                                weight_fn = comprehensive_weight, candidates = None, rng = random):
+    """
+    greedy_edge_picking_heuristic, or greedy_matching_heuristic with the
+    greedy engine if matching = True, where every edge is sampled by
+    softmax_index among the top_k heaviest candidates instead of always
+    taking the heaviest. top_k = 1 is the deterministic heuristic.
+    """
+    G = contraction_graph(D, N, candidates = candidates, aggregates = weight_fn in AGGREGATE_WEIGHTS)
+    if matching:
+        while len(G) > 1:
+            for u, v in randomized_greedy_matching(G, top_k, temperature, rng):
+                G.contract(u, v, D, N, weight_fn)
+        return list(G.payload.values())[0]
+    # same lazy max-heap as greedy_edge_picking_heuristic
+    version = {i : 0 for i in G.payload}
+    heap = []
+
+    def push(i, j):
+        if i > j:
+            i, j = j, i
+        heapq.heappush(heap, (-G.nbrs[i][j],) + G.edge_order(i, j) + (i, j, version[i], version[j]))
+
+    for i, j, w in G.edges():
+        push(i, j)
+    while len(G) > 1:
+        top = []
+        while len(top) < top_k and heap:
+            e = heapq.heappop(heap)
+            u, v = e[3], e[4]
+            if u in G.payload and v in G.payload and version[u] == e[5] and version[v] == e[6]:
+                top.append(e)
+        e = top.pop(softmax_index([-e[0] for e in top], temperature, rng))
+        for x in top:
+            heapq.heappush(heap, x)
+        u, v = e[3], e[4]
+        G.contract(u, v, D, N, weight_fn)
+        version[u] += 1
+        for x in G.nbrs[u]:
+            push(u, x)
+    return list(G.payload.values())[0]
+
+
+_multi_start_worker = {}
+
+def _init_multi_start_worker(D, N, kwargs):
+    _multi_start_worker.update(D = D, N = N, kwargs = kwargs)
+
+def _multi_start_run(task):
+    """
+    returns (cost, i, SG) of restart i, run with its own random.Random(seed);
+    restart 0 is the deterministic heuristic
+    """
+    i, seed = task
+    D, N, kwargs = (_multi_start_worker[k] for k in ("D", "N", "kwargs"))
+    if i == 0:
+        kwargs = dict(kwargs, top_k = 1)
+    SG = randomized_greedy_heuristic(D, N, rng = random.Random(seed), **kwargs)
+    return (SGTree(SG, demand_array(D, max(N) + 1)).cost, i, SG)
+
+
+def multi_start_heuristic(D, N, restarts = 16, processes = None, seed = None, ret_cost = False, **kwargs):
+    """
+    best skip graph of restarts runs of randomized_greedy_heuristic (kwargs are
+    passed on) in a pool of processes, restart i on its own stream spawned from seed.
+    """
+    # restart 0 is the deterministic heuristic, and ties go to the earlier restart
+    streams = np.random.SeedSequence(seed).spawn(restarts)
+    tasks = [(i, int(s.generate_state(1)[0])) for i, s in enumerate(streams)]
+    if processes == 1:
+        _init_multi_start_worker(D, N, kwargs)
+        results = [_multi_start_run(t) for t in tasks]
+    else:
+        with multiprocessing.Pool(processes, initializer = _init_multi_start_worker,
+                                  initargs = (D, N, kwargs)) as pool:
+            results = pool.map(_multi_start_run, tasks)
+    cost, i, SG = min(results, key = lambda x : x[:2])
+    if ret_cost:
+        return (cost, SG)
+    return SG
+
+def landing_arrays(keys, n):
+    """
+    mR, mL of the profile arrays of the sorted tuple keys on 0..n-1
+    """
+    keys = np.array(keys, dtype = np.int64)
+    ks = np.arange(n)
+    i = np.searchsorted(keys, ks, "right")
+    mR = np.where(i > 0, keys[np.maximum(i - 1, 0)], -1)
+    i = np.searchsorted(keys, ks)
+    mL = np.where(i < len(keys), keys[np.minimum(i, len(keys) - 1)], n)
+    return mR, mL
+
+
+def split_cost_arrays(P, Q):
+    """
+    st.profile_split_cost from the profile arrays P and Q of part and comp
+    """
+    s = 0.0
+    for X, Y in ((P, Q), (Q, P)):
+        cnt = Y[0]
+        wR, mR, wL, mL = X[1:]
+        s += float((wR*(cnt[1:] - cnt[mR + 1])).sum() + (wL*(cnt[mL] - cnt[:-1])).sum())
+    return s
+
+
+class SGTree:
+    """
+    Tupled SG as an explicit binary tree of its lists, with the profile
+    arrays and the split cost of every list, for scoring local moves.
+    Node 0 is the root list, kids[i] are the two sublists of list i (none
+    for a singleton) and leaf[x] is the node of the singleton list of x.
+    cost is the sum of the split costs, i.e. epl_SG.
+    """
+    def __init__(self, SG, M):
+        self.M = M
+        n = len(M)
+        self.keys, self.kids, self.parent = [], [], []
+        owner = {}
+        for S in sorted(set(SG), key = len, reverse = True):
+            i = len(self.keys)
+            p = owner.get(S[0])
+            self.keys.append(S)
+            self.kids.append([])
+            self.parent.append(p)
+            if p is not None:
+                self.kids[p].append(i)
+            for k in S:
+                owner[k] = i
+        self.leaf = {S[0] : i for i, S in enumerate(self.keys) if len(S) == 1}
+        ks = np.arange(n)
+        self.profiles = [None]*len(self.keys)
+        self.split = [0.0]*len(self.keys)
+        # sublists are shorter, so they come later
+        for i in reversed(range(len(self.keys))):
+            if self.kids[i]:
+                assert(len(self.kids[i]) == 2)
+                a, b = self.kids[i]
+                self.profiles[i] = self.combine(self.keys[i], [(1, a), (1, b)])
+                self.split[i] = split_cost_arrays(self.profiles[a], self.profiles[b])
+            else:
+                x = self.keys[i][0]
+                self.profiles[i] = ((np.arange(n + 1) > x).astype(np.int64), M[x]*(ks > x),
+                                    np.where(ks >= x, x, -1), M[x]*(ks < x), np.where(ks <= x, x, n))
+        self.cost = sum(self.split)
+
+    def combine(self, keys, terms):
+        """
+        profile arrays of the sorted tuple keys, whose keys are the signed
+        sum of the key sets of the nodes in terms [(sign, node), ...]
+        """
+        cnt, wR, wL = 0, 0, 0
+        for sign, i in terms:
+            P = self.profiles[i]
+            cnt, wR, wL = cnt + sign*P[0], wR + sign*P[1], wL + sign*P[3]
+        mR, mL = landing_arrays(keys, len(self.M))
+        return (cnt, wR, mR, wL, mL)
+
+    def path(self, i, top):
+        """
+        nodes strictly between top and its descendant i, from top down
+        """
+        p = []
+        i = self.parent[i]
+        while i != top:
+            p.append(i)
+            i = self.parent[i]
+        return p[::-1]
+
+    def toward(self, Z, i):
+        """
+        (child of Z on the way to its descendant i, other child)
+        """
+        a, b = self.kids[Z]
+        while i != a and i != b:
+            i = self.parent[i]
+        return (a, b) if i == a else (b, a)
+
+    def preorder(self, i = 0):
+        """
+        tupled SG of the subtree of node i, root first
+        """
+        SG = (self.keys[i],)
+        for c in self.kids[i]:
+            SG += self.preorder(c)
+        return SG
+
+    def relocate_delta(self, L, A, x, Y):
+        """
+        change of cost when key x moves from sublist A of L into its sibling
+        B, as a new singleton next to the node Y of the subtree of B
+        """
+        B = self.kids[L][0] if self.kids[L][1] == A else self.kids[L][1]
+        lx = self.leaf[x]
+        Apath = [A] + self.path(lx, A)
+        Bpath = ([B] + self.path(Y, B)) if Y != B else []
+        old = self.split[L] + sum(self.split[Z] for Z in Apath + Bpath)
+        new = split_cost_arrays(self.combine(tuple(k for k in self.keys[A] if k != x), [(1, A), (-1, lx)]),
+                                self.combine(tuple(sorted(self.keys[B] + (x,))), [(1, B), (1, lx)]))
+        for Z in Apath:
+            Zx, Zo = self.toward(Z, lx)
+            if Zx != lx:
+                new += split_cost_arrays(self.combine(tuple(k for k in self.keys[Zx] if k != x), [(1, Zx), (-1, lx)]),
+                                         self.profiles[Zo])
+        for Z in Bpath:
+            Zc, Zs = self.toward(Z, Y)
+            new += split_cost_arrays(self.combine(tuple(sorted(self.keys[Zc] + (x,))), [(1, Zc), (1, lx)]),
+                                     self.profiles[Zs])
+        new += split_cost_arrays(self.profiles[Y], self.profiles[lx])
+        return new - old
+
+    def replace(self, old, new):
+        """
+        puts node new in the place of node old under old's parent
+        """
+        p = self.parent[old]
+        self.kids[p][self.kids[p].index(old)] = new
+        self.parent[new] = p
+
+    def update(self, changes, nodes):
+        """
+        sets the keys and profiles of changes {node : (keys, terms)} (see
+        combine), then recomputes the split costs of nodes and the cost
+        """
+        profiles = {Z : self.combine(keys, terms) for Z, (keys, terms) in changes.items()}
+        for Z, (keys, terms) in changes.items():
+            self.keys[Z], self.profiles[Z] = keys, profiles[Z]
+        for Z in nodes:
+            a, b = self.kids[Z]
+            split = split_cost_arrays(self.profiles[a], self.profiles[b])
+            self.cost += split - self.split[Z]
+            self.split[Z] = split
+
+    def relocate(self, L, A, x, Y):
+        """
+        makes the move of relocate_delta in place, recomputing only the
+        lists on the paths from L to x and to Y. The parent of x's singleton
+        disappears with x, so its node is reused for the new list of Y and x.
+        """
+        B = self.kids[L][0] if self.kids[L][1] == A else self.kids[L][1]
+        lx = self.leaf[x]
+        P = self.parent[lx]
+        Apath = [Z for Z in [A] + self.path(lx, A) if Z != P]
+        Bpath = ([B] + self.path(Y, B)) if Y != B else []
+        changes = {Z : (tuple(k for k in self.keys[Z] if k != x), [(1, Z), (-1, lx)]) for Z in Apath}
+        changes.update({Z : (tuple(sorted(self.keys[Z] + (x,))), [(1, Z), (1, lx)]) for Z in Bpath})
+        # lift the sibling of x in place of P, then hang P above Y
+        self.replace(P, self.kids[P][0] if self.kids[P][1] == lx else self.kids[P][1])
+        self.replace(Y, P)
+        self.kids[P] = [Y, lx]
+        self.parent[Y] = self.parent[lx] = P
+        self.cost -= self.split[P]
+        self.split[P] = 0.0
+        changes[P] = (tuple(sorted(self.keys[Y] + (x,))), [(1, Y), (1, lx)])
+        self.update(changes, [L, P] + Apath + Bpath)
+
+    def swap_delta(self, L, X, Y):
+        """
+        change of cost when the subtrees X and Y below L trade places
+        """
+        Xpath, Ypath = self.path(X, L), self.path(Y, L)
+        old = sum(self.split[Z] for Z in [L] + Xpath + Ypath)
+        new = 0.0
+        for Z in [L] + Xpath + Ypath:
+            P = []
+            for c in self.kids[Z]:
+                if c == X:
+                    P.append(self.profiles[Y])
+                elif c == Y:
+                    P.append(self.profiles[X])
+                elif c in Xpath:
+                    keys = tuple(sorted(set(self.keys[c]) - set(self.keys[X]) | set(self.keys[Y])))
+                    P.append(self.combine(keys, [(1, c), (-1, X), (1, Y)]))
+                elif c in Ypath:
+                    keys = tuple(sorted(set(self.keys[c]) - set(self.keys[Y]) | set(self.keys[X])))
+                    P.append(self.combine(keys, [(1, c), (-1, Y), (1, X)]))
+                else:
+                    P.append(self.profiles[c])
+            new += split_cost_arrays(P[0], P[1])
+        return new - old
+
+    def swap(self, L, X, Y):
+        """
+        makes the move of swap_delta in place, recomputing only the lists
+        on the paths from L to X and to Y
+        """
+        Xpath, Ypath = self.path(X, L), self.path(Y, L)
+        changes = {}
+        for Z, out, into in [(Z, X, Y) for Z in Xpath] + [(Z, Y, X) for Z in Ypath]:
+            keys = tuple(sorted(set(self.keys[Z]) - set(self.keys[out]) | set(self.keys[into])))
+            changes[Z] = (keys, [(1, Z), (-1, out), (1, into)])
+        pX, pY = self.parent[X], self.parent[Y]
+        self.kids[pX][self.kids[pX].index(X)] = Y
+        self.kids[pY][self.kids[pY].index(Y)] = X
+        self.parent[X], self.parent[Y] = pY, pX
+        self.update(changes, [L] + Xpath + Ypath)
+
+    def moves(self, L):
+        """
+        yields the local moves below list L, as (kind, args) for
+        relocate_delta / swap_delta
+        """
+        a, b = self.kids[L]
+        for A, B in ((a, b), (b, a)):
+            if self.kids[A]:
+                for x in self.keys[A]:
+                    for Y in [B] + self.kids[B]:
+                        yield ("relocate", (L, A, x, Y))
+        for p, q in ((a, b), (b, a)):
+            for X in self.kids[p]:
+                yield ("swap", (L, X, q))
+                if p == a:
+                    for Y in self.kids[q]:
+                        yield ("swap", (L, X, Y))
+
+
+def local_search(SG, D, time_budget = None, ret_cost = False):
+    """
+    improves tupled SG for demand dict D (or st.SparseDemand) by local moves
+    until no move improves it or time_budget seconds have passed:
+    - relocate one key of a list to its sibling sublist, as a new singleton
+      next to the sibling or one of its sublists
+    - swap two subtrees: a sublist with its parent's sibling, or two cousins
+    Summing st.split_cost over the lists gives epl_SG, so a move is scored,
+    and then made in place, by recomputing the profiles and split costs of
+    the lists it changes only, each O(n) from the profile arrays of SGTree,
+    instead of a full epl_SG.
+    Lists are visited round robin and a move is taken as soon as it improves
+    the cost, until a whole round finds none.
+    """
+    start = time.time()
+    n = len(st.SG_nodes(SG))
+    tree = SGTree(SG, demand_array(D, n))
+    L, quiet = 0, 0
+    expired = False
+    while quiet < len(tree.keys) and not expired:
+        L = L % len(tree.keys)
+        improved = False
+        for kind, args in (tree.moves(L) if tree.kids[L] else ()):
+            if time_budget is not None and time.time() - start > time_budget:
+                expired = True
+                break
+            if getattr(tree, kind + "_delta")(*args) < -1e-9*max(1.0, tree.cost):
+                getattr(tree, kind)(*args)
+                improved = True
+                break
+        if improved:
+            quiet = 0
+        else:
+            quiet += 1
+            L += 1
+    SG = tree.preorder()
+    if ret_cost:
+        return (tree.cost, SG)
+    return SG
+
+
+class MembershipSG:
+    """
+    Skip graph as membership vectors {key : tuple of bits} of a common
+    height, with the profile arrays (cnt, wR, wL) of the keys sharing every
+    prefix and the split cost of every prefix whose keys split on the next
+    bit. cost is the sum of the split costs, i.e. epl_SG. Vectors are kept
+    distinct, so that every key ends up in a singleton list.
+    """
+    def __init__(self, vec, M):
+        self.M = M
+        self.n = len(M)
+        self.vec = dict(vec)
+        self.height = len(next(iter(self.vec.values())))
+        P = singleton_profile_arrays(M)
+        self.single = (P[0], P[1], P[3])
+        self.groups = {}
+        for x, bits in self.vec.items():
+            for k in range(self.height + 1):
+                self.groups[bits[:k]] = self.add(self.groups.get(bits[:k]), x, 1)
+        self.split = {}
+        for p in self.groups:
+            if len(p) < self.height:
+                c = self.split_cost(self.groups.get(p + (0,)), self.groups.get(p + (1,)))
+                if c:
+                    self.split[p] = c
+        self.cost = sum(self.split.values())
+        self.taken = set(self.vec.values())
+
+    def add(self, g, x, sign):
+        """
+        (cnt, wR, wL) of prefix group g with key x added (sign 1) or removed
+        (sign -1), None for an empty group
+        """
+        if g is None:
+            return tuple(a[x] for a in self.single)
+        g = tuple(a + sign*b[x] for a, b in zip(g, self.single))
+        return g if g[0][-1] else None
+
+    def profile(self, g):
+        cnt, wR, wL = g
+        ks = np.arange(self.n)
+        member = cnt[1:] > cnt[:-1]
+        mR = np.maximum.accumulate(np.where(member, ks, -1))
+        mL = np.minimum.accumulate(np.where(member, ks, self.n)[::-1])[::-1]
+        return (cnt, wR, mR, wL, mL)
+
+    def split_cost(self, g0, g1):
+        if g0 is None or g1 is None:
+            return 0
+        return split_cost_arrays(self.profile(g0), self.profile(g1))
+
+    def delta(self, changes):
+        """
+        returns (change of cost, groups, splits) when the keys x in changes get
+        the vectors changes[x]. Only the prefixes on the old and new paths of
+        the moved keys below their first changed bit are rescored.
+        """
+        groups = {}
+        prefixes = set()
+        for x, new in changes.items():
+            old = self.vec[x]
+            first = next(i for i in range(self.height) if old[i] != new[i])
+            for k in range(first + 1, self.height + 1):
+                for p, sign in ((old[:k], -1), (new[:k], 1)):
+                    groups[p] = self.add(groups[p] if p in groups else self.groups.get(p), x, sign)
+            for k in range(first, self.height):
+                prefixes.update((old[:k], new[:k]))
+        splits = {}
+        delta = 0
+        for p in prefixes:
+            g0, g1 = (groups[q] if q in groups else self.groups.get(q) for q in (p + (0,), p + (1,)))
+            splits[p] = self.split_cost(g0, g1)
+            delta += splits[p] - self.split.get(p, 0)
+        return (delta, groups, splits)
+
+    def apply(self, changes, delta, groups, splits):
+        for x, new in changes.items():
+            self.taken.discard(self.vec[x])
+        for x, new in changes.items():
+            self.vec[x] = new
+            self.taken.add(new)
+        for p, g in groups.items():
+            if g is None:
+                self.groups.pop(p, None)
+            else:
+                self.groups[p] = g
+        for p, c in splits.items():
+            if c:
+                self.split[p] = c
+            else:
+                self.split.pop(p, None)
+        self.cost += delta
+
+
+def simulated_annealing_SG(D, seed = None, iterations = 20000, time_budget = None, T0 = None,
+                           height = None, trace = None, ret_cost = False, rng = random):
+    """
+    searches skip graphs for demand dict D (or st.SparseDemand) by simulated
+    annealing over membership vectors, starting from tupled SG seed (a random
+    skip graph by default). A move flips one bit of a key's vector, or swaps
+    the suffixes of two keys' vectors from some level on; moves that would
+    give two keys the same vector are skipped. Moves are scored by
+    MembershipSG.delta, over the lists on the changed paths only.
+    The temperature decays geometrically from T0 (by default the mean cost
+    increase of a sample of moves) to T0/1000 over iterations moves or
+    time_budget seconds, whichever ends first.
+    Vectors have at least height bits (lg n + 2 by default).
+    If trace is a list, (seconds, best cost) is appended to it each time the
+    best skip graph improves.
+    """
+    start = time.time()
+    n = D.n if isinstance(D, st.SparseDemand) else int(math.sqrt(len(D)))
+    if seed is None:
+        seed = st.random_tupled_SG(n)
+    S = MembershipSG(st.tupled_SG_to_membership(seed, max(height or 0, lg(n) + 2)), demand_array(D, n))
+    keys = sorted(S.vec)
+
+    def move():
+        if n < 2:
+            return None
+        l = rng.randrange(S.height)
+        if rng.random() < 0.5:
+            x = rng.choice(keys)
+            bits = S.vec[x]
+            new = bits[:l] + (1 - bits[l],) + bits[l+1:]
+            return {x : new} if new not in S.taken else None
+        x, y = rng.sample(keys, 2)
+        vx, vy = S.vec[x], S.vec[y]
+        new_x, new_y = vx[:l] + vy[l:], vy[:l] + vx[l:]
+        if new_x == vx or new_x in S.taken - {vx, vy} or new_y in S.taken - {vx, vy}:
+            return None
+        return {x : new_x, y : new_y}
+
+    if T0 is None:
+        ups = [d for d in (S.delta(m)[0] for m in (move() for i in range(100)) if m) if d > 0]
+        T0 = sum(ups)/len(ups) if ups else 1.0
+    best, best_vec = S.cost, dict(S.vec)
+    if trace is not None:
+        trace.append((time.time() - start, best))
+    i = 0
+    while True:
+        progress = i/iterations if iterations is not None else 0
+        if time_budget is not None:
+            progress = max(progress, (time.time() - start)/time_budget)
+        if progress >= 1:
+            break
+        i += 1
+        changes = move()
+        if changes is None:
+            continue
+        delta, groups, splits = S.delta(changes)
+        T = T0*0.001**progress
+        if delta <= 0 or rng.random() < math.exp(-delta/T):
+            S.apply(changes, delta, groups, splits)
+            if S.cost < best - 1e-9*max(1.0, abs(best)):
+                best, best_vec = S.cost, dict(S.vec)
+                if trace is not None:
+                    trace.append((time.time() - start, best))
+    SG = st.membership_to_tupled_SG(best_vec)
+    if ret_cost:
+        # rescored from scratch, free of the rounding of the running deltas
+        return (MembershipSG(best_vec, S.M).cost, SG)
+    return SG
+
+
+def heavy_edge_matching(m, a, b, w, tie = None):
+    """
+    returns match where match[i] is the vertex matched with i (or i itself)
+    in a heavy-edge matching of the graph on vertices 0..m-1 with edges
+    (a, b, w), listed in both directions. In every round each unmatched
+    vertex proposes to its heaviest edge to an unmatched vertex, ties broken
+    by the larger tie (if given), then by whether the smaller endpoint is
+    odd and then by a unique edge key, and mutual proposals are matched,
+    until no edge is left between unmatched vertices. The heaviest edge
+    left is always mutual, so every round makes progress. The parity key
+    makes a run of equal edges between consecutive vertices, such as a
+    chain of keys with no demand, pair up (2i, 2i+1) in one round instead
+    of one pair per round.
+    """
+    lo = np.minimum(a, b)
+    eid = lo*m + np.maximum(a, b)
+    if tie is None:
+        tie = np.zeros(len(a))
+    order = np.lexsort((-eid, lo % 2, -tie, -w, a))
+    a, b = a[order], b[order]
+    match = np.arange(m)
+    free = np.ones(m, dtype = bool)
+    while matching_round(m, a, b, match, free):
+        pass
+    return match
+
+
+def matching_round(m, a, b, match, free):
+    """
+    one round of heavy_edge_matching on the edges (a, b) sorted by
+    proposal order: matches the mutual proposals between free vertices in
+    match and free, or returns False if no edge is left between them
+    """
+    ok = free[a] & free[b]
+    if not ok.any():
+        return False
+    aa, bb = a[ok], b[ok]
+    first = np.ones(len(aa), dtype = bool)
+    first[1:] = aa[1:] != aa[:-1]
+    prop = np.full(m, -1)
+    prop[aa[first]] = bb[first]
+    v = np.nonzero(prop >= 0)[0]
+    v = v[(prop[prop[v]] == v) & (v < prop[v])]
+    match[v], match[prop[v]] = prop[v], v
+    free[v] = free[prop[v]] = False
+    return True
+
+
+def merge_full_profiles(P, Q):
+    """
+    union of two disjoint clusters' full sparse profiles (keys, ups, wR, wL),
+    where ups are all the keys the cluster has demand to, inside it or not
+    """
+    keys = np.sort(np.concatenate((P[0], Q[0])))
+    ups, inv = np.unique(np.concatenate((P[1], Q[1])), return_inverse = True)
+    return (keys, ups) + tuple(np.bincount(inv, np.concatenate((P[c], Q[c])), len(ups)) for c in (2, 3))
+
+
+def sparse_split_cost(P, Q):
+    """
+    st.split_cost from the full sparse profiles of part and comp, in time
+    linear in the demand pairs leaving them
+    """
+    s = 0.0
+    for X, Y in ((P, Q), (Q, P)):
+        keys, ups, wR, wL = X
+        comp = Y[0]
+        k = len(ups)
+        i = np.searchsorted(keys, ups, "right")
+        j = np.searchsorted(keys, ups)
+        # landing keys mR (last key <= u) and mL (first key >= u)
+        r = np.searchsorted(comp, np.concatenate((ups, keys[np.maximum(i - 1, 0)])), "right")
+        l = np.searchsorted(comp, np.concatenate((keys[np.minimum(j, len(keys) - 1)], ups)))
+        s += float(wR @ np.where(i > 0, r[:k] - r[k:], 0) + wL @ np.where(j < len(keys), l[:k] - l[k:], 0))
+    return s
+
+
+def sparse_epl_SG(SG, D):
+    """
+    epl_SG of tupled SG for st.SparseDemand D, summing sparse_split_cost
+    over the lists from the bottom up, in O((n + nnz) log n) per level of
+    the skip graph and without any n x n array
+    """
+    lists = sorted(set(SG), key = len)
+    profiles, owner, cost = {}, {}, 0.0
+    for S in lists:
+        if len(S) == 1:
+            profiles[S] = sparse_singleton_profile(D, S[0])[:4]
+        else:
+            # the two sublists are the largest lists below S so far
+            A = owner[S[0]]
+            B = next(owner[k] for k in S if owner[k] is not A)
+            cost += sparse_split_cost(profiles[A], profiles[B])
+            profiles[S] = merge_full_profiles(profiles.pop(A), profiles.pop(B))
+        for k in S:
+            owner[k] = S
+    return cost
+
+
+def multilevel_SG(D, refine_passes = 2, ret_cost = False):
+    """
+    multilevel heuristic for large sparse demands, in the style of METIS.
+    Coarsening: the graph with weights |u - v|(D(u,v) + D(v,u)), plus
+    zero-weight edges between neighbours in key order to keep it connected,
+    is shrunk by heavy_edge_matching until one cluster is left. Weights are
+    summed over merged clusters, as constant_distance_weight would, and
+    divided by the product of the cluster sizes, with ties going to
+    clusters whose smallest keys are far apart. Clusters left unmatched
+    are paired with each other in order, so there are O(log n) levels.
+    Every matched pair becomes a list whose sublists are the two clusters,
+    so the coarsening hierarchy is a skip graph.
+    Uncoarsening: from the root down, each list tries to swap a sublist of
+    one of its sublists with the other sublist or with one of its
+    sublists, taking the best improving swap up to refine_passes times.
+    Swaps are scored with sparse_split_cost over the three lists they
+    change. Each level of coarsening and of refinement is O(n + nnz).
+    D is a demand dict or a st.SparseDemand on keys 0..n-1.
+    """
+    if not isinstance(D, st.SparseDemand):
+        D = st.sparse_demand(D)
+    n = D.n
+    off = D.u != D.v
+    chain = np.arange(n - 1)
+    a = np.concatenate((D.u[off], D.v[off], chain, chain + 1))
+    b = np.concatenate((D.v[off], D.u[off], chain + 1, chain))
+    w = np.concatenate((D.w[off], D.w[off], np.zeros(2*(n - 1))))*np.abs(a - b)
+    # kids[i] are the sublists of list i, keys 0..n-1 are the singletons
+    kids = [None]*n
+    node = np.arange(n)
+    size = np.ones(n)
+    lo = np.arange(n)
+    m = n
+    while m > 1:
+        pair, inv = np.unique(a*m + b, return_inverse = True)
+        a, b, w = pair//m, pair % m, np.bincount(inv, w, len(pair))
+        match = heavy_edge_matching(m, a, b, w/(size[a]*size[b]), np.abs(lo[a] - lo[b]))
+        # pair up what the matching left over, so every level halves m
+        left = np.nonzero(match == np.arange(m))[0]
+        x, y = left[0:len(left) - 1:2], left[1::2]
+        match[x], match[y] = y, x
+        rep = np.arange(m) <= match
+        cid = np.cumsum(rep) - 1
+        cmap = cid[np.minimum(np.arange(m), match)]
+        new = np.empty(cid[-1] + 1, dtype = np.int64)
+        for i in np.nonzero(rep)[0].tolist():
+            j = int(match[i])
+            if j == i:
+                new[cid[i]] = node[i]
+            else:
+                new[cid[i]] = len(kids)
+                kids.append([int(node[i]), int(node[j])])
+        node, m = new, len(new)
+        a, b = cmap[a], cmap[b]
+        keep = a != b
+        a, b, w = a[keep], b[keep], w[keep]
+    root = int(node[0])
+
+    # full sparse profiles and split costs, bottom up (sublists come first)
+    profiles = [sparse_singleton_profile(D, x)[:4] for x in range(n)]
+    split = [0.0]*n
+    for i in range(n, len(kids)):
+        A, B = kids[i]
+        profiles.append(merge_full_profiles(profiles[A], profiles[B]))
+        split.append(sparse_split_cost(profiles[A], profiles[B]))
+
+    def swap_options(L):
+        """
+        yields (X, Y) such that swapping the subtrees X and Y changes only
+        the sublists of L
+        """
+        A, B = kids[L]
+        for P, Q in ((A, B), (B, A)):
+            for X in kids[P] or ():
+                yield (X, Q)
+        for X in kids[A] or ():
+            for Y in kids[B] or ():
+                yield (X, Y)
+
+    def after_swap(L, X, Y):
+        """
+        {list : (sublists, profile, split)} for the lists of L's subtree that
+        change when subtrees X and Y trade places
+        """
+        out = {}
+        # children of L that hold X or Y, innermost first
+        for Z in kids[L]:
+            if kids[Z] is not None and (X in kids[Z] or Y in kids[Z]):
+                out[Z] = [Y if c == X else X if c == Y else c for c in kids[Z]]
+        out[L] = [Y if c == X else X if c == Y else c for c in kids[L]]
+        changes = {}
+        for Z in [Z for Z in out if Z != L] + [L]:
+            c0, c1 = (changes[c][1] if c in changes else profiles[c] for c in out[Z])
+            # L keeps its keys, so its profile does not change
+            P = profiles[L] if Z == L else merge_full_profiles(c0, c1)
+            changes[Z] = (out[Z], P, sparse_split_cost(c0, c1))
+        return changes
+
+    queue = [root]
+    while queue:
+        L = queue.pop()
+        if kids[L] is None:
+            continue
+        for p in range(refine_passes):
+            # swaps only move splits of L and its sublists, none below 0
+            if split[L] + sum(split[Z] for Z in kids[L]) == 0:
+                break
+            best = None
+            for X, Y in swap_options(L):
+                changes = after_swap(L, X, Y)
+                delta = sum(c[2] - split[Z] for Z, c in changes.items())
+                if delta < -1e-9*max(1.0, split[L]) and (best is None or delta < best[0]):
+                    best = (delta, changes)
+            if best is None:
+                break
+            for Z, (k, P, c) in best[1].items():
+                kids[Z], profiles[Z], split[Z] = k, P, c
+        queue.extend(kids[L])
+
+    SG = []
+    stack = [root]
+    while stack:
+        i = stack.pop()
+        SG.append(tuple(profiles[i][0].tolist()))
+        if kids[i] is not None:
+            stack.extend(reversed(kids[i]))
+    SG = tuple(SG)
+    if ret_cost:
+        return (sum(split), SG)
+    return SG
+
+
+def exact_subtree_refinement(SG, D, max_size = 8, deadline = None, ret_cost = False):
+    """
+    replaces the subtree of every list of at most max_size keys of tupled SG
+    by the optimal subtree on the same keys, from the branch and bound solver
+    of static_optimal_search. The cost of a subtree only depends on which
+    keys its lists hold, so each subtree is solved on its own. Lists are
+    visited largest first and skipped once time.time() passes deadline.
+    """
+    n = len(st.SG_nodes(SG))
+    tree = SGTree(SG, demand_array(D, n))
+    cost = tree.cost
+    lists = set(SG)
+    solve = st.branch_and_bound_solver(D, n)[0]
+    for i in range(len(tree.keys)):
+        L = tree.keys[i]
+        if not 2 < len(L) <= max_size or L not in lists:
+            continue
+        if deadline is not None and time.time() > deadline:
+            break
+        stack, old = [i], 0.0
+        while stack:
+            j = stack.pop()
+            old += tree.split[j]
+            stack.extend(tree.kids[j])
+        result = solve(st.keys_to_mask(L), old)
+        if result is not None and result[0] < old - 1e-9*max(1.0, old):
+            lists = {S for S in lists if not set(S) <= set(L)} | set(result[1])
+            cost += result[0] - old
+    SG = SGTree(tuple(lists), tree.M).preorder()
+    if ret_cost:
+        return (cost, SG)
+    return SG
+
+
+# one-shot heuristics tried by anytime_SG, cheapest first
+ANYTIME_HEURISTICS = [lambda D, N: multilevel_SG(D),
+                      lambda D, N: greedy_matching_heuristic(D, N, matching = "greedy"),
+                      lambda D, N: greedy_edge_picking_heuristic(D, N),
+                      lambda D, N: greedy_matching_heuristic(D, N)]
+
+# the heuristics that never build an n x n array, for large sparse demands
+ANYTIME_SPARSE_HEURISTICS = [lambda D, N: multilevel_SG(D),
+                             lambda D, N: greedy_matching_heuristic(D, N, candidates = 8, matching = "greedy"),
+                             lambda D, N: greedy_edge_picking_heuristic(D, N, candidates = 8)]
+
+# largest st.SparseDemand anytime_SG handles with dense arrays
+ANYTIME_DENSE_SIZE = 2000
+
+_anytime_worker = {}
+
+def _init_anytime_worker(D, n, sparse):
+    heuristics = ANYTIME_SPARSE_HEURISTICS if sparse else ANYTIME_HEURISTICS
+    _anytime_worker.update(D = D, N = list(range(n)), heuristics = heuristics)
+
+def _anytime_heuristic(i):
+    return _anytime_worker["heuristics"][i](_anytime_worker["D"], _anytime_worker["N"])
+
+
+def anytime_SG(D, time_budget = None, deadline = None, callback = None, exact_size = 8,
+               ret_cost = False, rng = random):
+    """
+    anytime search for a skip graph with low EPL under demand dict D (or
+    st.SparseDemand), for when min_epl_exhaustive_SG may not finish.
+    Starts from the interleaved SG and runs ANYTIME_HEURISTICS in a worker
+    process, then alternates local_search, exact_subtree_refinement
+    (subtrees of up to exact_size keys) and simulated_annealing_SG restarts
+    from the best skip graph, each restart getting half of the time left.
+    Stops at deadline (a time.time() value) or after time_budget seconds,
+    whichever comes first; a heuristic still running then is terminated.
+    With neither, it stops after one round of refinement.
+    A st.SparseDemand on more than ANYTIME_DENSE_SIZE keys is scored with
+    sparse_epl_SG and only gets the ANYTIME_SPARSE_HEURISTICS, without the
+    refinements, which all work on n x n arrays.
+    Every improving (cost, SG) is passed to callback as it is found, and a
+    KeyboardInterrupt stops the search with the best skip graph so far.
+    """
+    start = time.time()
+    if time_budget is not None:
+        deadline = start + time_budget if deadline is None else min(deadline, start + time_budget)
+    n = D.n if isinstance(D, st.SparseDemand) else int(math.sqrt(len(D)))
+    sparse = isinstance(D, st.SparseDemand) and n > ANYTIME_DENSE_SIZE
+    if sparse:
+        heuristics, score = ANYTIME_SPARSE_HEURISTICS, lambda SG : sparse_epl_SG(SG, D)
+    else:
+        M = demand_array(D, n)
+        heuristics, score = ANYTIME_HEURISTICS, lambda SG : SGTree(SG, M).cost
+    best = [math.inf, None]
+
+    def offer(cost, SG):
+        if best[1] is None or cost < best[0] - 1e-9*max(1.0, abs(best[0])):
+            best[:] = [cost, SG]
+            if callback is not None:
+                callback(cost, SG)
+
+    def left():
+        return math.inf if deadline is None else deadline - time.time()
+
+    try:
+        SG = st.interleaved_tupled_SG(n)
+        offer(score(SG), SG)
+        with multiprocessing.Pool(1, initializer = _init_anytime_worker, initargs = (D, n, sparse)) as pool:
+            for i in range(len(heuristics)):
+                if left() <= 0:
+                    break
+                job = pool.apply_async(_anytime_heuristic, (i,))
+                try:
+                    SG = job.get(None if deadline is None else left())
+                except multiprocessing.TimeoutError:
+                    break
+                offer(score(SG), SG)
+        while not sparse and left() > 0:
+            offer(*local_search(best[1], D, time_budget = left(), ret_cost = True))
+            if left() <= 0:
+                break
+            offer(*exact_subtree_refinement(best[1], D, exact_size, deadline, ret_cost = True))
+            if deadline is None or left() < 0.01:
+                break
+            offer(*simulated_annealing_SG(D, seed = best[1], iterations = None, time_budget = left()/2,
+                                          ret_cost = True, rng = rng))
+    except KeyboardInterrupt:
+        pass
+    if ret_cost:
+        return tuple(best)
+    return best[1]
+
 
 def lg(n):
     i = 0
@@ -202,7 +2010,7 @@ def scaling_data(start, end, step = 1, trials_per_iter = 100):
             #csvwriter.writerow([n, sum(R)/len(R),sum(E)/len(E),sum(M)/len(M)])
             csvwriter.writerow([n, sum(I)/len(I)])
 
-def approx_ratio_data(n, trials = 100, optimal = True):
+def approx_ratio_data(n, trials = 100, optimal = True, cache = None):
     """
     Returns a list L of 3 lists
     L = [A, B, C]
@@ -210,7 +2018,12 @@ def approx_ratio_data(n, trials = 100, optimal = True):
     B ------------------------, of approx ratios for edge picking heuristic
     C ------------------------, of approx ratios for random skip graph
     n is size of skip graph, D is input demand graph
+    cache is a result_cache.ResultCache to keep the optimal skip graphs in
+    across runs
     """
+    solve = st.min_epl_exhaustive_SG
+    if cache is not None:
+        solve = result_cache.cached(cache)(solve)
     fname = "data.csv"
     with open(fname, "w") as csvfile:
         csvwriter = csv.writer(csvfile)
@@ -221,7 +2034,7 @@ def approx_ratio_data(n, trials = 100, optimal = True):
             D = st.g.random_demand_dict(n)
             really_safe_normalise_in_place(D)
             if optimal:
-                optcost, opt = st.min_epl_exhaustive_SG(D, ret_cost = True)
+                optcost, opt = solve(D, ret_cost = True)
             else:
                 optcost = 1
             # random = st.random_tupled_SG(n)
@@ -237,6 +2050,46 @@ def approx_ratio_data(n, trials = 100, optimal = True):
             i = st.epl_SG(I, D)/optcost
             csvwriter.writerow([i])
 
+def demand_families(n):
+    """
+    returns {name : demand dict} for the demand families of the generator
+    """
+    F = {"uniform" : st.g.uniform_demand_dict(n),
+         "random" : st.g.random_demand_dict(n),
+         "single_source" : st.g.single_source_demand_dict(0, n),
+         "two_cluster" : st.g.two_cluster_demand_dict(n, n//2 - 1, n//2),
+         "n_cluster" : st.g.n_cluster_demand_dict(n, [list(range(i, min(i + 4, n))) for i in range(0, n, 4)])}
+    if n & (n - 1) == 0:
+        F["balancedtree"] = st.g.balancedtree_demand_dict(n)
+    return F
+
+
+def matching_engine_data(n, trials = 10, fname = "matching_engines.csv"):
+    """
+    runs greedy_matching_heuristic with every engine in MATCHING_ENGINES on
+    every demand family and writes the mean EPL (relative to the blossom
+    matching) and running time per family and engine
+    """
+    with open(fname, "w") as csvfile:
+        csvwriter = csv.writer(csvfile)
+        csvwriter.writerow(["Family", "Engine", "EPL", "Ratio", "Seconds"])
+        N = list(range(n))
+        for t in range(trials):
+            for family, D in demand_families(n).items():
+                really_safe_normalise_in_place(D)
+                exact = None
+                for engine in MATCHING_ENGINES:
+                    start = time.time()
+                    SG = greedy_matching_heuristic(D, N, matching = engine)
+                    seconds = time.time() - start
+                    epl = st.epl_SG(SG, D)
+                    if exact is None:
+                        exact = epl
+                    csvwriter.writerow([family, engine, epl, epl/exact, seconds])
+    data = pd.read_csv(fname)
+    return data.groupby(["Family", "Engine"]).mean()
+
+
 def histogram(inp_file, interleaved = None):
     data = pd.read_csv(inp_file)
     rand = data["Random"]
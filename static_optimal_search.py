@@ -1,7 +1,10 @@
+import array
 import itertools
 import math
 import random
 import bisect
+import multiprocessing
+import numpy as np
 import generator as g
 import pydot
 
@@ -50,6 +53,147 @@ def all_SGs_rooted_at(subset, C, balanced = False):
 
 
 
+def iter_SGs_rooted_at(subset, balanced = False):
+    """
+    lazily yields all skip graphs rooted at subset, in the same order as
+    all_SGs_rooted_at, without storing them.
+    Memory is bounded by the recursion depth, at the price of regenerating
+    the right subtrees once per left subtree.
+    balanced = True: yields only balanced skip graphs rooted at subset
+    """
+    if len(subset) == 1:
+        yield (subset,)
+        return
+    for subsubset in powerset(subset):
+        if balanced:
+            cond = len(subsubset) == len(subset)//2
+        else:
+            cond = len(subsubset) <= len(subset)//2
+        if len(subsubset) > 0 and cond:
+            othersubsubset = tuple(x for x in subset if x not in subsubset)
+            for left_sgs in iter_SGs_rooted_at(subsubset, balanced):
+                for right_sgs in iter_SGs_rooted_at(othersubsubset, balanced):
+                    yield (subset,) + left_sgs + right_sgs
+
+
+def SG_dag_on(V, balanced = False):
+    """
+    Returns the hash-consed DAG of all skip graphs on node set V as (nodes, C).
+    nodes[i] = (subset, left, right) is a sub skip graph rooted at subset whose
+    two sublists are the sub skip graphs with IDs left and right (None for a
+    single key). Every sub skip graph is stored once, children before parents.
+    C[subset] lists the IDs of all sub skip graphs rooted at subset, in the
+    same order as all_SGs_rooted_at.
+    """
+    nodes = []
+    C = {}
+    for subset in list(powerset(V)): # in order of length
+        if len(subset) == 0:
+            continue
+        C[subset] = []
+        if len(subset) == 1:
+            C[subset].append(len(nodes))
+            nodes.append((subset, None, None))
+            continue
+        for subsubset in powerset(subset):
+            if balanced:
+                cond = len(subsubset) == len(subset)//2
+            else:
+                cond = len(subsubset) <= len(subset)//2
+            if len(subsubset) > 0 and cond:
+                othersubsubset = tuple(x for x in subset if x not in subsubset)
+                for left in C[subsubset]:
+                    for right in C[othersubsubset]:
+                        C[subset].append(len(nodes))
+                        nodes.append((subset, left, right))
+    return nodes, C
+
+def dag_to_tupled_SG(nodes, i):
+    """
+    expands the sub skip graph with ID i of a SG_dag_on DAG into a tupled SG
+    """
+    subset, left, right = nodes[i]
+    if left is None:
+        return (subset,)
+    return (subset,) + dag_to_tupled_SG(nodes, left) + dag_to_tupled_SG(nodes, right)
+
+def dag_costs(nodes, D):
+    """
+    returns a list c where c[i] is the cost of the sub skip graph with ID i,
+    i.e. the sum of split_cost over its splits. For a skip graph on all keys
+    this is its epl_SG. Each shared subtree and each split is scored once.
+    """
+    n = int(math.sqrt(len(D)))
+    profiles = {}
+    splits = {}
+    c = []
+    for subset, left, right in nodes:
+        if left is None:
+            c.append(0)
+            continue
+        part, comp = nodes[left][0], nodes[right][0]
+        if (part, comp) not in splits:
+            for x in (part, comp):
+                if x not in profiles:
+                    profiles[x] = subset_profile(D, n, x)
+            splits[(part, comp)] = profile_split_cost(profiles[part], profiles[comp])
+        c.append(splits[(part, comp)] + c[left] + c[right])
+    return c
+
+
+def subtree_cost_memo(V, D, balanced = False):
+    """
+    Returns memo, where memo[subset][i] (a compact array of floats) is the cost (sum of split_cost over its
+    splits) of the i-th skip graph rooted at subset in iter_SGs_rooted_at
+    order, for every proper subset of V. Costs are filled bottom up: the cost
+    of a sub skip graph is the cost of its split plus the memoized costs of
+    its two children, so intra-subset costs are never rescored.
+    """
+    n = int(math.sqrt(len(D)))
+    memo = {}
+    profiles = {}
+    for subset in list(powerset(V)): # in order of length
+        if len(subset) == 0 or len(subset) == len(V):
+            continue
+        profiles[subset] = subset_profile(D, n, subset)
+        if len(subset) == 1:
+            memo[subset] = array.array("d", [0])
+            continue
+        memo[subset] = array.array("d")
+        for part, comp in memo_splits(subset, balanced):
+            c = profile_split_cost(profiles[part], profiles[comp])
+            right = memo[comp]
+            for a in memo[part]:
+                memo[subset].extend([c + a + b for b in right])
+    return memo
+
+def memo_splits(subset, balanced = False):
+    """
+    the (part, comp) splits of subset, in iter_SGs_rooted_at order
+    """
+    for subsubset in powerset(subset):
+        if balanced:
+            cond = len(subsubset) == len(subset)//2
+        else:
+            cond = len(subsubset) <= len(subset)//2
+        if len(subsubset) > 0 and cond:
+            yield (subsubset, tuple(x for x in subset if x not in subsubset))
+
+def memo_to_tupled_SG(memo, subset, i, balanced = False):
+    """
+    returns the i-th skip graph rooted at subset, in iter_SGs_rooted_at order
+    """
+    if len(subset) == 1:
+        return (subset,)
+    for part, comp in memo_splits(subset, balanced):
+        count = len(memo[part])*len(memo[comp])
+        if i < count:
+            left = memo_to_tupled_SG(memo, part, i // len(memo[comp]), balanced)
+            right = memo_to_tupled_SG(memo, comp, i % len(memo[comp]), balanced)
+            return (subset,) + left + right
+        i -= count
+
+
 def SG_nodes(SG):
     """
     returns nodes in SG, as tuple of ints
@@ -75,10 +219,154 @@ def all_balanced_SGs_on(V):
         all_SGs_rooted_at(subset, C, balanced = True)
     return C[tuple(V)]
 
+def iter_SGs_on(V):
+    """
+    Generator version of all_SGs_on
+    """
+    return iter_SGs_rooted_at(tuple(V))
+
+def iter_balanced_SGs_on(V):
+    """
+    Generator version of all_balanced_SGs_on
+    """
+    return iter_SGs_rooted_at(tuple(V), balanced = True)
+
+class SparseDemand(dict):
+    """
+    Demand dict on keys 0..n-1 that only stores the nonzero pairs, built from
+    COO arrays u, v, w (repeated pairs are summed). Missing pairs read as 0,
+    iterating visits only the nonzero pairs, and rows[u] lists the (v, w)
+    with nonzero demand from u. The arrays u, v, w hold the nonzero pairs in
+    key order. rows and the arrays are rebuilt on first use after the dict
+    is changed, e.g. by really_safe_normalise_in_place.
+    """
+    def __init__(self, n, u, v, w):
+        super().__init__()
+        self.n = n
+        for a, b, c in zip(u, v, w):
+            self[(a,b)] = self.get((a,b), 0) + c
+        for k in [k for k in self if self[k] == 0]:
+            del self[k]
+
+    def __missing__(self, k):
+        return 0
+
+    def arrays(self):
+        """
+        returns (rows, u, v, w), rebuilt if the dict changed since last time
+        """
+        if getattr(self, "cached", None) is None:
+            keys = sorted(k for k in self if self[k] != 0)
+            rows = [[] for i in range(self.n)]
+            for k in keys:
+                rows[k[0]].append((k[1], self[k]))
+            self.cached = (rows, np.array([k[0] for k in keys], dtype = np.int64),
+                           np.array([k[1] for k in keys], dtype = np.int64), np.array([self[k] for k in keys]))
+        return self.cached
+
+    rows = property(lambda self : self.arrays()[0])
+    u = property(lambda self : self.arrays()[1])
+    v = property(lambda self : self.arrays()[2])
+    w = property(lambda self : self.arrays()[3])
+
+    def changed(self):
+        self.cached = None
+
+    def __setitem__(self, k, w):
+        super().__setitem__(k, w)
+        self.changed()
+
+    def __delitem__(self, k):
+        super().__delitem__(k)
+        self.changed()
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self.changed()
+
+    def setdefault(self, k, w = 0):
+        self.changed()
+        return super().setdefault(k, w)
+
+    def pop(self, *args):
+        self.changed()
+        return super().pop(*args)
+
+    def popitem(self):
+        self.changed()
+        return super().popitem()
+
+    def clear(self):
+        super().clear()
+        self.changed()
+
+    def copy(self):
+        keys = list(self)
+        return SparseDemand(self.n, [k[0] for k in keys], [k[1] for k in keys], [self[k] for k in keys])
+
+
+def sparse_demand(D):
+    """
+    returns the SparseDemand holding the nonzero pairs of demand dict D
+    """
+    n = int(math.sqrt(len(D)))
+    keys = [k for k in D if D[k] != 0]
+    return SparseDemand(n, [k[0] for k in keys], [k[1] for k in keys], [D[k] for k in keys])
+
+
+def demand_pairs(D, sources, targets):
+    """
+    yields (u, v, D[(u,v)]) for every u in sources and v in set targets
+    with nonzero demand. Only visits the nonzero pairs if D is a SparseDemand.
+    """
+    if isinstance(D, SparseDemand):
+        for u in sources:
+            for v, w in D.rows[u]:
+                if v in targets:
+                    yield (u, v, w)
+    else:
+        for u in sources:
+            for v in targets:
+                if D[(u,v)] != 0:
+                    yield (u, v, D[(u,v)])
+
+
+class IndexedSG:
+    """
+    Tupled SG with the skip list restriction of every node and the position
+    of every key in every list precomputed, so that a search costs
+    O(height log n) instead of rescanning and sorting the lists of SG.
+    Iterates like the tupled SG it wraps, and can be passed anywhere a
+    tupled SG is expected.
+    """
+    def __init__(self, SG):
+        self.SG = tuple(SG)
+        self.restrictions = {}
+        self.positions = {}
+        for tup in self.SG:
+            self.positions[tup] = {key : i for i, key in enumerate(tup)}
+            for u in tup:
+                self.restrictions.setdefault(u, []).append(tup)
+        for u in self.restrictions:
+            self.restrictions[u].sort(key = len)
+
+    def __iter__(self):
+        return iter(self.SG)
+
+    def __len__(self):
+        return len(self.SG)
+
+
 def SL_restriction(SG,u):
     """
     returns the skip list restriction of node u in skip graph SG
     """
+    if isinstance(SG, IndexedSG):
+        return list(SG.restrictions[u])
     SL = []
     for tup in SG:
         if u in tup:
@@ -97,10 +385,11 @@ def adjacent_in(SG, u, v):
                 return True
     return False
 
-def SL_search_cost(SL, u, v, return_value = False):
+def SL_search_cost(SL, u, v, return_value = False, pos = None):
     """
     computes cost for u to search v in Skip list restriction of u, when SL is a
     tuple of tuples sorted by increasing length
+    pos optionally maps each list to a dict from key to position (see IndexedSG)
     """
     if u == v:
         if return_value:
@@ -115,7 +404,10 @@ def SL_search_cost(SL, u, v, return_value = False):
     cost = 0
     for tup in SL:
         next = find(tup, v)
-        cost += abs(tup.index(curr) - tup.index(next))
+        if pos:
+            cost += abs(pos[tup][curr] - pos[tup][next])
+        else:
+            cost += abs(tup.index(curr) - tup.index(next))
         if next == v:
             curr = next
             if return_value:
@@ -127,10 +419,11 @@ def SL_search_cost(SL, u, v, return_value = False):
     return cost
 
 
-def SL_search_cost_zigzag(SL, u, v, return_value = False):
+def SL_search_cost_zigzag(SL, u, v, return_value = False, pos = None):
     """
     computes cost for u to search v in Skip list restriction of u, when SL is a
     tuple of tuples sorted by increasing length (with zigzag method)
+    pos optionally maps each list to a dict from key to position (see IndexedSG)
     """
     if u == v:
         if return_value:
@@ -148,7 +441,10 @@ def SL_search_cost_zigzag(SL, u, v, return_value = False):
     cost = 0
     for tup in SL:
         next = find(tup, v)
-        cost += abs(tup.index(curr) - tup.index(next))
+        if pos:
+            cost += abs(pos[tup][curr] - pos[tup][next])
+        else:
+            cost += abs(tup.index(curr) - tup.index(next))
         if next == v:
             curr = next
             if return_value:
@@ -159,10 +455,11 @@ def SL_search_cost_zigzag(SL, u, v, return_value = False):
         return (cost, curr)
     return cost
 
-def SL_search_path(SL, u,v):
+def SL_search_path(SL, u,v, pos = None):
     """
     computes search path for u to search v in Skip list restriction of u, when SL is a
     tuple of tuples sorted by increasing length
+    pos optionally maps each list to a dict from key to position (see IndexedSG)
     """
     path = set([u])
     if u == v:
@@ -175,12 +472,13 @@ def SL_search_path(SL, u,v):
     curr = u
     for tup in SL:
         next = find(tup, v)
+        index = pos[tup].__getitem__ if pos else tup.index
         if curr <= next:
-            for i in range(tup.index(curr), tup.index(next)):
+            for i in range(index(curr), index(next)):
                 path.add(tup[i])
             path.add(next)
         else:
-            for i in range(tup.index(next), tup.index(curr)):
+            for i in range(index(next), index(curr)):
                 path.add(tup[i])
             path.add(curr)
         if next == v:
@@ -191,26 +489,60 @@ def SL_search_path(SL, u,v):
 def SG_search_cost(SG, u,v, return_value = False, zigzag = False):
     """
     computes cost to search from u to v in skip graph SG
+    SG can be a tupled SG or an IndexedSG
     """
-    uSL = SL_restriction(SG, u)
+    if isinstance(SG, IndexedSG):
+        uSL, pos = SG.restrictions[u], SG.positions
+    else:
+        uSL, pos = SL_restriction(SG, u), None
     if not zigzag:
-        return SL_search_cost(uSL, u, v, return_value)
+        return SL_search_cost(uSL, u, v, return_value, pos)
     else:
-        return SL_search_cost_zigzag(uSL, u, v, return_value)
+        return SL_search_cost_zigzag(uSL, u, v, return_value, pos)
 
 
 def SG_search_path(SG, u, v):
     """
     returns the path to search from u to v in skip graph SG
+    SG can be a tupled SG or an IndexedSG
     """
+    if isinstance(SG, IndexedSG):
+        return SL_search_path(SG.restrictions[u], u, v, SG.positions)
     uSL = SL_restriction(SG,u)
     return SL_search_path(uSL, u, v)
 
 
+def popcount(mask):
+    return bin(mask).count("1")
+
+def keys_to_mask(keys):
+    """
+    returns the bitmask with bit k set for every key k in keys
+    """
+    mask = 0
+    for k in keys:
+        mask |= 1 << k
+    return mask
+
+def mask_to_keys(mask):
+    """
+    returns the keys in bitmask mask, as a sorted tuple
+    """
+    keys = []
+    while mask:
+        low = mask & -mask
+        keys.append(low.bit_length() - 1)
+        mask ^= low
+    return tuple(keys)
+
+
 def epl_SG(SG,D, optimized = math.inf):
     """
     computes expected path length of SG given demand dict D
+    (only the nonzero pairs are visited if D is a SparseDemand)
     """
+    if not isinstance(SG, IndexedSG):
+        SG = IndexedSG(SG)
     aggregate = 0
     for k in D:
         u,v = k[0], k[1]
@@ -221,19 +553,376 @@ def epl_SG(SG,D, optimized = math.inf):
     return aggregate
 
 
-def min_epl_exhaustive_SG(D, balanced = False, ret_cost = False):
+def SG_cost_matrix(SG, zigzag = False):
+    """
+    returns the matrix C where C[i][j] = SG_search_cost(SG, u, v, zigzag = zigzag)
+    for the i-th and j-th smallest keys u, v of SG (C[u][v] for a SG on 0..n-1).
+    Lists are processed from shortest to longest, moving every search that
+    starts in a list at once with searchsorted, instead of one search at a time.
+    With zigzag = True, searches for a key outside the range of a list move to
+    the nearest end of the list, where SG_search_cost raises ValueError.
+    """
+    nodes = np.array(SG_nodes(SG))
+    n = len(nodes)
+    keys = np.arange(n)
+    C = np.zeros((n, n), dtype = np.int64)
+    curr = np.repeat(keys[:, None], n, axis = 1) # curr[u][v]: where the search u -> v is
+    rightward = keys[None, :] > keys[:, None]
+    rank = np.zeros(n, dtype = np.int64)
+    for tup in sorted(SG, key = len):
+        if len(tup) == 1:
+            continue
+        L = np.searchsorted(nodes, tup)
+        rank[L] = np.arange(len(L))
+        i = np.searchsorted(L, keys, side = "right") - 1
+        j = np.searchsorted(L, keys, side = "left")
+        le = L[np.maximum(i, 0)]
+        ge = L[np.minimum(j, len(L) - 1)]
+        if zigzag:
+            closer = np.abs(nodes[le] - nodes) < np.abs(nodes[ge] - nodes)
+            closest = np.where((i >= 0) & (closer | (j == len(L))), le, ge)
+            next = np.broadcast_to(closest, (len(L), n))
+        else:
+            next = np.where(rightward[L], le[None, :], ge[None, :])
+        C[L] += np.abs(rank[curr[L]] - rank[next])
+        curr[L] = next
+    return C
+
+
+def epl_SG_vectorized(SG, D, zigzag = False):
+    """
+    computes expected path length of SG given demand dict D (or an n x n
+    demand matrix) as (C*D).sum() for C = SG_cost_matrix(SG)
+    """
+    if isinstance(D, SparseDemand):
+        return (SG_cost_matrix(SG, zigzag)[D.u, D.v] * D.w).sum()
+    if isinstance(D, dict):
+        D = demand_as_matrix(D)
+    return (SG_cost_matrix(SG, zigzag) * np.asarray(D)).sum()
+
+
+def subset_profile(D, n, subset):
+    """
+    returns (cnt, wR, mR, wL, mL) for sorted tuple subset, where
+    cnt[k] is the number of keys of subset below k,
+    wR[v] is the demand from keys of subset left of v to v and mR[v] the
+    rightmost key of subset <= v (wL, mL likewise from the right)
+    """
+    cnt = [0]*(n + 1)
+    wR, mR = [0]*n, [-1]*n
+    wL, mL = [0]*n, [n]*n
+    i = 0
+    for k in range(n):
+        if i < len(subset) and subset[i] == k:
+            i += 1
+        cnt[k+1] = i
+    for v in range(n):
+        i = cnt[v+1]
+        if i:
+            mR[v] = subset[i-1]
+            for u in subset[:cnt[v]]:
+                wR[v] += D[(u,v)]
+        if cnt[v] != len(subset):
+            mL[v] = subset[cnt[v]]
+            for u in subset[i:]:
+                wL[v] += D[(u,v)]
+    return (cnt, wR, mR, wL, mL)
+
+
+def profile_split_cost(P, Q):
+    """
+    split_cost from the subset_profile of part and of comp
+    """
+    s = 0
+    for X, Y in ((P, Q), (Q, P)):
+        cnt = Y[0]
+        wR, mR, wL, mL = X[1:]
+        for v in range(len(wR)):
+            if wR[v]:
+                s += wR[v]*(cnt[v+1] - cnt[mR[v]+1])
+            if wL[v]:
+                s += wL[v]*(cnt[mL[v]] - cnt[v])
+    return s
+
+
+def split_cost(D, n, part, comp):
+    """
+    returns the demand-weighted hops spent in the list part + comp by searches
+    that start in part and move into comp, and vice versa.
+    part and comp are sorted tuples. Summing split_cost over every split of a
+    tupled SG gives epl_SG, so the cost of a subtree only depends on the subtree.
+    """
+    return profile_split_cost(subset_profile(D, n, part), subset_profile(D, n, comp))
+
+
+def subset_lower_bound(D, n, subset):
+    """
+    admissible lower bound on the cost of any skip graph rooted at subset:
+    every search from u in subset that has to move past another key of
+    subset costs at least one hop inside the subtree
+    """
+    s = 0
+    for i in range(len(subset)):
+        u = subset[i]
+        if i + 1 < len(subset):
+            for v in range(subset[i+1], n):
+                s += D[(u,v)]
+        if i > 0:
+            for v in range(0, subset[i-1] + 1):
+                s += D[(u,v)]
+    return s
+
+
+def branch_and_bound_solver(D, n, balanced = False):
+    """
+    returns functions (solve, splits, solve_split) sharing one memo table.
+
+    Subsets are bitmasks of keys (see keys_to_mask).
+    solve(subset, budget) returns (cost, subtree) of the optimal tupled
+    subtree rooted at subset if its cost is at most budget, None otherwise.
+    splits(subset) returns the candidate splits (bound, cost, part, comp) of
+    subset, sorted by split cost plus the static lower bounds of both parts.
+    solve_split(subset, c, part, comp, budget) is solve restricted to one split.
+    Ties are broken by the order of splits, so the optimal subtree found for
+    a subset does not depend on the budgets it was solved with.
+    """
+    exact = {}  # subset -> (cost, tupled subtree) of the optimal subtree
+    failed = {}  # subset -> largest budget its optimal subtree is known to exceed
+    bounds = {}
+    profiles = {}
+
+    def profile(subset):
+        if subset not in profiles:
+            profiles[subset] = subset_profile(D, n, mask_to_keys(subset))
+        return profiles[subset]
+
+    def static_bound(subset):
+        if subset not in bounds:
+            bounds[subset] = subset_lower_bound(D, n, mask_to_keys(subset))
+        return bounds[subset]
+
+    def lower_bound(subset):
+        if subset in exact:
+            return exact[subset][0]
+        return max(static_bound(subset), failed.get(subset, -math.inf))
+
+    def splits(subset):
+        S = []
+        size = popcount(subset)
+        part = subset
+        while part:
+            part = (part - 1) & subset
+            if balanced:
+                cond = popcount(part) == size//2
+            else:
+                cond = popcount(part) <= size//2
+            if part and cond:
+                comp = subset ^ part
+                c = profile_split_cost(profile(part), profile(comp))
+                S.append((c + static_bound(part) + static_bound(comp), c, part, comp))
+        S.sort(key = lambda x : x[0])
+        return S
+
+    def solve_split(subset, c, part, comp, budget):
+        if c + lower_bound(part) + lower_bound(comp) > budget:
+            return None
+        left = solve(part, budget - c - lower_bound(comp))
+        if left is None:
+            return None
+        right = solve(comp, budget - c - left[0])
+        if right is None:
+            return None
+        # smaller sublist first, as iter_SGs_rooted_at lists them
+        first, second = sorted((left[1], right[1]), key = lambda S : (len(S[0]), S[0]))
+        return (c + left[0] + right[0], (mask_to_keys(subset),) + first + second)
+
+    def solve(subset, budget):
+        if subset in exact:
+            if exact[subset][0] <= budget:
+                return exact[subset]
+            return None
+        if subset & (subset - 1) == 0:
+            exact[subset] = (0, (mask_to_keys(subset),))
+            return exact[subset]
+        if lower_bound(subset) > budget or budget <= failed.get(subset, -math.inf):
+            return None
+
+        best = None
+        for bound, c, part, comp in splits(subset):
+            if bound > budget or (best is not None and bound >= best[0]):
+                break
+            if best is not None and c + lower_bound(part) + lower_bound(comp) >= best[0]:
+                continue
+            result = solve_split(subset, c, part, comp, budget)
+            if result is not None and (best is None or result[0] < best[0]):
+                best = result
+                budget = best[0]
+        if best is None:
+            failed[subset] = max(budget, failed.get(subset, -math.inf))
+            return None
+        exact[subset] = best
+        return best
+
+    return solve, splits, solve_split
+
+
+def min_epl_branch_and_bound_SG(D, balanced = False, ret_cost = False, incumbent = None):
+    """
+    Returns the skip graph on n nodes with minimal expected path length
+    given demand D, by building the partition tree top down and pruning
+    splits whose cost plus the lower bounds of their parts exceed the best
+    skip graph found so far.
+
+    incumbent is a tupled SG used as the starting upper bound, e.g. from
+    static_opt_heuristics.greedy_matching_heuristic. Defaults to the
+    interleaved SG.
+    Pruning is only as good as subset_lower_bound: random demands at n = 12
+    solve in seconds, but uniform demands at n = 16 take minutes.
+    """
+    n = int(math.sqrt(len(D)))
+    V = tuple(range(n))
+    if n == 1:
+        return (0, (V,)) if ret_cost else (V,)
+    if incumbent is None:
+        incumbent = interleaved_tupled_SG(n)
+    upper = epl_SG(incumbent, D)
+
+    solve = branch_and_bound_solver(D, n, balanced)[0]
+    result = solve(keys_to_mask(V), upper)
+    if result is None:
+        result = (upper, incumbent)
+    if ret_cost:
+        return result
+    return result[1]
+
+
+_shard_worker = {}
+
+def _init_shard_worker(D, balanced, method, bound, lock):
+    n = int(math.sqrt(len(D)))
+    _shard_worker.update(D = D, n = n, balanced = balanced, method = method, bound = bound, lock = lock)
+    if method == "branch_and_bound":
+        _shard_worker["solve_split"] = branch_and_bound_solver(D, n, balanced)[2]
+
+def _solve_shard(shard):
+    """
+    returns (i, (cost, SG)) for the best skip graph whose root split is
+    (part, comp), or (i, None) if it cannot beat the shared bound
+    """
+    i, c, part, comp = shard
+    D, n, balanced, bound, lock = (_shard_worker[k] for k in ("D", "n", "balanced", "bound", "lock"))
+    V = tuple(range(n))
+    best = None
+    if _shard_worker["method"] == "branch_and_bound":
+        best = _shard_worker["solve_split"](keys_to_mask(V), c, part, comp, bound.value)
+    else:
+        min_cost = math.inf
+        for left in iter_SGs_rooted_at(part, balanced):
+            for right in iter_SGs_rooted_at(comp, balanced):
+                SG = (V,) + left + right
+                # only prune skip graphs strictly worse than the bound, so that
+                # ties are kept and resolved in enumeration order
+                cost = epl_SG(SG, D, optimized = math.nextafter(min(min_cost, bound.value), math.inf))
+                if cost != -1 and cost < min_cost:
+                    min_cost = cost
+                    best = (cost, SG)
+    if best is not None:
+        with lock:
+            if best[0] < bound.value:
+                bound.value = best[0]
+    return (i, best)
+
+
+def min_epl_parallel_SG(D, balanced = False, ret_cost = False, method = "enumerate", processes = None,
+                        incumbent = None):
+    """
+    Same as min_epl_exhaustive_SG, but shards the search by the split of the
+    root list across a pool of processes (os.cpu_count() if processes is None).
+    Workers share the cost of the best skip graph found so far to prune each
+    other's shards, and ties are broken in the serial order, so the result is
+    the same as the serial search.
+    method is "branch_and_bound" or "enumerate", and incumbent the starting
+    upper bound (see min_epl_branch_and_bound_SG)
+    """
+    n = int(math.sqrt(len(D)))
+    V = tuple(range(n))
+    if n < 2 or method not in ("branch_and_bound", "enumerate"):
+        raise ValueError("parallel search needs n >= 2 and method branch_and_bound or enumerate")
+
+    if incumbent is None:
+        incumbent = interleaved_tupled_SG(n)
+    if method == "branch_and_bound":
+        splits = branch_and_bound_solver(D, n, balanced)[1](keys_to_mask(V))
+        shards = [(i, c, part, comp) for i, (bound, c, part, comp) in enumerate(splits)]
+    else:
+        shards = [(i, None, part, comp) for i, (part, comp) in enumerate(memo_splits(V, balanced))]
+
+    bound = multiprocessing.Value("d", epl_SG(incumbent, D), lock = False)
+    lock = multiprocessing.Lock()
+    best = None
+    with multiprocessing.Pool(processes, initializer = _init_shard_worker,
+                              initargs = (D, balanced, method, bound, lock)) as pool:
+        for i, result in pool.imap_unordered(_solve_shard, shards):
+            if result is not None and (best is None or (result[0], i) < (best[0][0], best[1])):
+                best = (result, i)
+    if best is None:
+        result = (epl_SG(incumbent, D), incumbent)
+    else:
+        result = best[0]
+    if ret_cost:
+        return result
+    return result[1]
+
+
+def min_epl_exhaustive_SG(D, balanced = False, ret_cost = False, method = "enumerate", processes = 1,
+                          incumbent = None):
     """
     Returns the skip graph on n nodes with minimal expected path length
     given demand D
 
     balanced = True: searches over only balanced skip graphs (number of nodes must be pow of 2)
+    method = "branch_and_bound": see min_epl_branch_and_bound_SG, starting from incumbent
+    method = "dag": scores every skip graph on the shared-subtree DAG from SG_dag_on
+    method = "memo": scores every skip graph from the child costs in subtree_cost_memo
+    method = "enumerate": streams and scores every skip graph from iter_SGs_on
+    processes > 1 (or None for all cores): see min_epl_parallel_SG
     """
+    if processes != 1:
+        return min_epl_parallel_SG(D, balanced = balanced, ret_cost = ret_cost, method = method, processes = processes,
+                                   incumbent = incumbent)
+    if method == "branch_and_bound":
+        return min_epl_branch_and_bound_SG(D, balanced = balanced, ret_cost = ret_cost, incumbent = incumbent)
     n = int(math.sqrt(len(D)))
+    if method == "memo":
+        V = tuple(range(0,n))
+        if n == 1:
+            return (0, (V,)) if ret_cost else (V,)
+        memo = subtree_cost_memo(V, D, balanced)
+        min_cost, best, i = math.inf, None, 0
+        for part, comp in memo_splits(V, balanced):
+            c = split_cost(D, n, part, comp)
+            for a in memo[part]:
+                for b in memo[comp]:
+                    if c + a + b < min_cost:
+                        min_cost, best = c + a + b, i
+                    i += 1
+        best = memo_to_tupled_SG(memo, V, best, balanced)
+        if ret_cost:
+            return (min_cost, best)
+        return best
+    if method == "dag":
+        V = tuple(range(0,n))
+        nodes, C = SG_dag_on(V, balanced = balanced)
+        c = dag_costs(nodes, D)
+        best = min(C[V], key = lambda i : c[i])
+        if ret_cost:
+            return (c[best], dag_to_tupled_SG(nodes, best))
+        return dag_to_tupled_SG(nodes, best)
     #print("generating all skip graphs...")
     if balanced:
-        SGs = all_balanced_SGs_on(list(range(0,n)))
+        SGs = iter_balanced_SGs_on(list(range(0,n)))
     else:
-        SGs = all_SGs_on(list(range(0,n)))
+        SGs = iter_SGs_on(list(range(0,n)))
 
     min_cost = math.inf
     best_so_far = None
@@ -338,8 +1027,8 @@ def interleaved_tupled_SG(n):
             SG.append([L[0]])
             SG.append([L[1]])
             return
-        l = [i for i in L if L.index(i) % 2 == 0]
-        r = [i for i in L if L.index(i) % 2 != 0]
+        l = L[0::2]
+        r = L[1::2]
         SG.append(l)
         SG.append(r)
         helper(l)
@@ -439,6 +1128,47 @@ def random_tupled_SG(n):
 
 
 
+def tupled_SG_to_membership(SG, height = None):
+    """
+    returns {key : membership vector} of tupled SG, as tuples of bits of a
+    common length (at least height). The sublist holding the smaller key of a
+    list gets bit 0, and keys whose list stops splitting are padded with 0s.
+    """
+    kids = {}
+    owner = {}
+    for S in sorted(set(SG), key = len, reverse = True):
+        if S[0] in owner:
+            kids.setdefault(owner[S[0]], []).append(S)
+        for k in S:
+            owner[k] = S
+    vec = {}
+    def helper(L, bits):
+        if L not in kids:
+            vec[L[0]] = bits
+            return
+        for b, S in enumerate(sorted(kids[L])):
+            helper(S, bits + (b,))
+    helper(max(SG, key = len), ())
+    h = max([len(bits) for bits in vec.values()] + [height or 0])
+    return {k : bits + (0,)*(h - len(bits)) for k, bits in vec.items()}
+
+
+def membership_to_tupled_SG(vec):
+    """
+    returns the tupled SG, root first, of the membership vectors
+    {key : tuple of bits}: the lists are the keys sharing each prefix.
+    Vectors must be distinct.
+    """
+    def helper(L, level):
+        if len(L) == 1:
+            return (tuple(L),)
+        parts = ([k for k in L if vec[k][level] == 0], [k for k in L if vec[k][level] == 1])
+        if not parts[0] or not parts[1]:
+            return helper(L, level + 1)
+        return (tuple(L),) + helper(parts[0], level + 1) + helper(parts[1], level + 1)
+    return helper(sorted(vec), 0)
+
+
 def partition_increment_cost(D, partition, complement):
     SG = (partition, complement, tuple(sorted(partition + complement)))
     s = 0
@@ -451,31 +1181,112 @@ def partition_increment_cost(D, partition, complement):
 
 
 
+def min_increment_partition(D, base):
+    """
+    returns (cost, part, comp) minimizing partition_increment_cost(D, part, comp)
+    over all part of base with 0 < len(part) <= len(base)//2, ties broken in
+    powerset order.
+
+    The labellings of base are visited in Gray code order, so consecutive
+    candidates differ by one key moving between part and comp. With keys
+    x_0 < ... < x_m-1 of base, a search from x_i to x_j (i < j) costs the number
+    of keys in (x_i, x_j] on its own side, plus j - p, where x_p is the last key
+    <= x_j on its own side (and symmetrically for i > j). Both sums are kept
+    up to date in O(m) per move instead of rescoring the whole 3-list SG.
+    """
+    x = sorted(base)
+    m = len(x)
+    W = [[D[(a,b)] for b in x] for a in x]
+    RS = [[0]*(m + 1) for i in range(m)] # RS[i][k] = sum of W[i][k:]
+    LS = [[0]*(m + 1) for i in range(m)] # LS[i][k] = sum of W[i][:k+1]
+    for i in range(m):
+        for k in range(m - 1, -1, -1):
+            RS[i][k] = RS[i][k+1] + W[i][k]
+        t = 0
+        for k in range(m):
+            t += W[i][k]
+            LS[i][k] = t
+    lab = [0]*m
+    # CLR[l][j]: demand to x_j from keys left of it labelled l (CLL: right of it)
+    CLR = [[sum(W[i][j] for i in range(j)) for j in range(m)], [0]*m]
+    CLL = [[sum(W[i][j] for i in range(j + 1, m)) for j in range(m)], [0]*m]
+
+    def same_side_terms(k):
+        s = 0
+        for i in range(m):
+            if i != k and lab[i] == lab[k]:
+                if i < k:
+                    s += RS[i][k] + LS[k][i]
+                else:
+                    s += LS[i][k] + RS[k][i]
+        return s
+
+    def landing_terms():
+        s = 0
+        for l in (0, 1):
+            last = -1
+            for j in range(m):
+                if lab[j] == l:
+                    last = j
+                if last >= 0:
+                    s += (j - last)*CLR[l][j]
+            first = -1
+            for j in range(m - 1, -1, -1):
+                if lab[j] == l:
+                    first = j
+                if first >= 0:
+                    s += (first - j)*CLL[l][j]
+        return s
+
+    same_side = sum(RS[i][k] + LS[k][i] for k in range(m) for i in range(k))
+    size = 0
+    best_cost, best_key = math.inf, None
+    # the last key stays in comp: each partition and its mirror image are
+    # both scored from the same labelling
+    for code in range(1, 2**(m - 1)):
+        k = (code & -code).bit_length() - 1
+        same_side -= same_side_terms(k)
+        old = lab[k]
+        lab[k] = 1 - old
+        same_side += same_side_terms(k)
+        size += 1 if old == 0 else -1
+        for j in range(k + 1, m):
+            CLR[old][j] -= W[k][j]
+            CLR[1 - old][j] += W[k][j]
+        for j in range(k):
+            CLL[old][j] -= W[k][j]
+            CLL[1 - old][j] += W[k][j]
+
+        cost = 2*(same_side + landing_terms())
+        if cost > best_cost:
+            continue
+        for side, length in ((1, size), (0, m - size)):
+            if 0 < length <= m//2:
+                part = set(x[p] for p in range(m) if lab[p] == side)
+                key = (cost, length, sorted(i for i in range(m) if base[i] in part))
+                if best_key is None or key < best_key:
+                    best_cost, best_key = cost, key
+    part = tuple(base[i] for i in best_key[2])
+    return (best_cost, part, tuple(sorted(set(base) - set(part))))
+
+
 def min_increment_partition_heuristic(D, N):
     """
     starting with N = [0,...,n-1], finds subset S of N such that
     epl increment is minimized between S --- N -- N \ S, and does this recursively.
     Even though this is exponential time, how good does this get?
+    Candidate subsets are scored incrementally, see min_increment_partition.
     """
     SG = [tuple(N)]
 
     def helper(base):
         if len(base) == 1:
             return
-        P = list(powerset(base))
-        min_cost = math.inf
-        best_so_far = None
-        for part in P:
-            if len(part) <= len(base)//2 and len(part) > 0:
-                comp = tuple(set(base) - set(part))
-                t = partition_increment_cost(D, part, comp)
-                if t < min_cost:
-                    min_cost = t
-                    best_so_far = [part, comp]
-        SG.append(best_so_far[0])
-        SG.append(best_so_far[1])
-        helper(best_so_far[0])
-        helper(best_so_far[1])
+        min_cost, part, comp = min_increment_partition(D, base)
+        SG.append(part)
+        SG.append(comp)
+        helper(part)
+        helper(comp)
 
     helper(SG[0])
     return tuple(SG)
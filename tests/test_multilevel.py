@@ -0,0 +1,30 @@
+import numpy as np
+import static_opt_heuristics as hr
+import static_optimal_search as st
+
+
+def chain(m):
+    c = np.arange(m - 1)
+    return np.concatenate((c, c + 1)), np.concatenate((c + 1, c))
+
+
+def test_chain_matching_takes_constant_rounds(monkeypatch):
+    rounds = []
+    matching_round = hr.matching_round
+
+    def counted(*args):
+        rounds.append(1)
+        return matching_round(*args)
+    monkeypatch.setattr(hr, "matching_round", counted)
+    for m in (1000, 4000):
+        a, b = chain(m)
+        del rounds[:]
+        match = hr.heavy_edge_matching(m, a, b, np.zeros(len(a)))
+        assert (match == np.arange(m) ^ 1).all()
+        assert len(rounds) <= 2
+
+
+def test_multilevel_on_chain():
+    m = 1000
+    SG = hr.multilevel_SG(st.SparseDemand(m, [0], [m - 1], [1.0]))
+    assert len(SG) == 2*m - 1 and sorted(SG[0]) == list(range(m))
@@ -0,0 +1,12 @@
+import pytest
+import static_optimal_search as st
+
+
+@pytest.mark.parametrize("n, balanced", [(6, False), (8, True)])
+@pytest.mark.parametrize("method", ["branch_and_bound", "enumerate"])
+def test_parallel_matches_serial(n, balanced, method):
+    for t in range(2):
+        D = st.g.random_demand_dict(n)
+        serial = st.min_epl_exhaustive_SG(D, balanced = balanced, ret_cost = True, method = method)
+        parallel = st.min_epl_exhaustive_SG(D, balanced = balanced, ret_cost = True, method = method, processes = 2)
+        assert serial == parallel
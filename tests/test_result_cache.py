@@ -0,0 +1,32 @@
+import static_opt_heuristics as hr
+import static_optimal_search as st
+import result_cache
+
+
+def test_lambdas_do_not_collide():
+    D = st.g.random_demand_dict(4)
+    first = lambda U, V, D, N : 1
+    second = lambda U, V, D, N : 2
+    keys = [result_cache.cache_key(D, hr.greedy_edge_picking_heuristic, w) for w in (first, second)]
+    assert keys[0] != keys[1]
+
+
+def test_anytime_heuristics_do_not_collide():
+    for heuristics in (hr.ANYTIME_HEURISTICS, hr.ANYTIME_SPARSE_HEURISTICS):
+        assert len({result_cache.stable_repr(f) for f in heuristics}) == len(heuristics)
+
+
+def test_closures_key_on_their_cells():
+    def scaled(c):
+        return lambda U, V, D, N : c*hr.comprehensive_weight(U, V, D, N)
+    assert result_cache.stable_repr(scaled(1)) == result_cache.stable_repr(scaled(1))
+    assert result_cache.stable_repr(scaled(1)) != result_cache.stable_repr(scaled(2))
+
+
+def test_cached_keeps_results_apart(tmp_path):
+    cache = result_cache.ResultCache(str(tmp_path))
+    D = st.g.random_demand_dict(6)
+    N = list(range(6))
+    solve = result_cache.cached(cache)(hr.greedy_edge_picking_heuristic)
+    for w in (lambda U, V, D, N : 1, lambda U, V, D, N : -hr.comprehensive_weight(U, V, D, N)):
+        assert solve(D, N, w) == tuple(hr.greedy_edge_picking_heuristic(D, N, w))
@@ -72,6 +72,7 @@ def middleman_hop_frequencies(D, SG):
     d = D.copy()
     #really_safe_normalise_in_place(d)
 
+    SG = st.IndexedSG(SG)
     nodes = st.SG_nodes(SG)
     freqs = {n : 0 for n in nodes}
     for u in nodes:
@@ -92,6 +93,7 @@ def middleman_hop_frequencies_node_specific(D, SG, u):
     d = D.copy()
     #really_safe_normalise_in_place(d)
 
+    SG = st.IndexedSG(SG)
     nodes = st.SG_nodes(SG)
     freqs = {n : 0 for n in nodes}
     for v in nodes:
@@ -112,6 +114,7 @@ def epl_contribution_freqs(D, SG):
     d = D.copy()
     #really_safe_normalise_in_place(d)
 
+    SG = st.IndexedSG(SG)
     nodes = st.SG_nodes(SG)
     freqs = {n : 0 for n in nodes}
     for u in nodes: